@@ -0,0 +1,233 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Background sampler of 'ceph df' and 'osd df' kept in fixed-size ring buffers.
+
+Readers get the latest values, growth rates and time-to-full projections from
+memory, without running a toolbox command. NumPy is required for the sampler
+only; the rest of the client does not depend on it.
+"""
+
+import threading
+import time
+
+import scheduler as scheduler
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CLUSTER = 'cluster'
+POOL = 'pool'
+OSD = 'osd'
+
+CLUSTER_FIELDS = ('total_bytes', 'total_used_bytes', 'total_avail_bytes')
+POOL_FIELDS = ('stored', 'bytes_used', 'objects', 'max_avail')
+OSD_FIELDS = ('bytes', 'bytes_used', 'bytes_avail', 'pgs')
+
+# The field that grows towards full and the field holding what is left.
+FULL_FIELDS = {
+    CLUSTER: ('total_used_bytes', 'total_avail_bytes'),
+    POOL: ('stored', 'max_avail'),
+    OSD: ('bytes_used', 'bytes_avail'),
+}
+
+
+class RingBuffer(object):
+    """
+    The last `capacity` samples of a fixed set of numeric fields.
+    """
+
+    def __init__(self, fields, capacity):
+        self.fields = fields
+        self.capacity = capacity
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._values = np.zeros((capacity, len(fields)), dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, values):
+        self._times[self._next] = timestamp
+        self._values[self._next] = values
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def latest(self):
+        if not self._count:
+            return None
+        index = (self._next - 1) % self.capacity
+        sample = dict(zip(self.fields, self._values[index].tolist()))
+        sample['timestamp'] = float(self._times[index])
+        return sample
+
+    def series(self, field, window=None):
+        """
+        Return (times, values) of a field in chronological order, limited
+        to the last `window` seconds when given.
+        """
+        order = (np.arange(self._count) + self._next - self._count) % \
+            self.capacity
+        times = self._times[order]
+        values = self._values[order, self.fields.index(field)]
+        if window is not None and self._count:
+            keep = times >= times[-1] - window
+            times, values = times[keep], values[keep]
+        return times, values
+
+
+class CapacitySampler(object):
+
+    def __init__(self, api, interval=60, capacity=1440,
+                 priority=scheduler.Priority.audit):
+        if np is None:
+            raise ImportError("numpy is required by the capacity sampler")
+        self.api = api
+        self.interval = interval
+        self.capacity = capacity
+        self.priority = priority
+        self._buffers = {CLUSTER: {}, POOL: {}, OSD: {}}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='rookclient-capacity-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # Sampling is not urgent, let interactive calls go first.
+                with self.api.priority(self.priority):
+                    self.sample()
+            except Exception as e:
+                print("Fail to sample ceph capacity: %s." % e)
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        ceph_df = self.api.ceph_df()
+        osd_df = self.api.osd_df()
+        now = time.time()
+
+        # Only the kinds whose payload was fetched are updated.
+        rows = {}
+        if ceph_df:
+            rows[CLUSTER] = {}
+            rows[POOL] = {}
+            stats = ceph_df.get('stats', {})
+            rows[CLUSTER][CLUSTER] = [
+                stats.get('total_bytes', 0),
+                stats.get('total_used_bytes',
+                          stats.get('total_used_raw_bytes', 0)),
+                stats.get('total_avail_bytes', 0)]
+            for pool in ceph_df.get('pools', []):
+                pool_stats = pool.get('stats', {})
+                rows[POOL][pool['name']] = [
+                    pool_stats.get('stored', pool_stats.get('bytes_used', 0)),
+                    pool_stats.get('bytes_used', 0),
+                    pool_stats.get('objects', 0),
+                    pool_stats.get('max_avail', 0)]
+        if osd_df:
+            rows[OSD] = {}
+            for node in osd_df.get('nodes', []):
+                if node.get('type') != 'osd':
+                    continue
+                rows[OSD][node['id']] = [
+                    node.get('kb', 0) * 1024,
+                    node.get('kb_used', 0) * 1024,
+                    node.get('kb_avail', 0) * 1024,
+                    node.get('pgs', 0)]
+
+        fields = {CLUSTER: CLUSTER_FIELDS, POOL: POOL_FIELDS, OSD: OSD_FIELDS}
+        with self._lock:
+            for kind, samples in rows.items():
+                # Forget pools and osds that are gone from the cluster.
+                for key in set(self._buffers[kind]) - set(samples):
+                    del self._buffers[kind][key]
+                for key, values in samples.items():
+                    buf = self._buffers[kind].get(key)
+                    if buf is None:
+                        buf = RingBuffer(fields[kind], self.capacity)
+                        self._buffers[kind][key] = buf
+                    buf.append(now, values)
+
+    '''
+    Read Interfaces, kind is one of CLUSTER, POOL or OSD and key the pool
+    name or osd id (CLUSTER for the cluster totals).
+    '''
+
+    def keys(self, kind):
+        with self._lock:
+            return list(self._buffers[kind])
+
+    def latest(self, kind, key=CLUSTER):
+        with self._lock:
+            buf = self._buffers[kind].get(key)
+            if buf is None:
+                return None
+            return buf.latest()
+
+    def series(self, kind, key, field, window=None):
+        with self._lock:
+            buf = self._buffers[kind].get(key)
+            if buf is None:
+                return None
+            times, values = buf.series(field, window)
+            return times.copy(), values.copy()
+
+    def rate(self, kind, key, field, window=None):
+        """
+        Growth of field in units per second, the least-squares slope over
+        the samples of the last `window` seconds. None with under 2 samples.
+        """
+        series = self.series(kind, key, field, window)
+        if series is None:
+            return None
+        times, values = series
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        dt = times - times.mean()
+        return float(np.dot(dt, values - values.mean()) / np.dot(dt, dt))
+
+    def time_to_full(self, kind, key=CLUSTER, window=None):
+        """
+        Seconds until the space left is used at the current growth rate,
+        float('inf') when not growing, None without enough samples.
+        """
+        used_field, avail_field = FULL_FIELDS[kind]
+        rate = self.rate(kind, key, used_field, window)
+        if rate is None:
+            return None
+        if rate <= 0:
+            return float('inf')
+        return self.latest(kind, key)[avail_field] / rate
@@ -22,6 +22,13 @@ import shutil
 import json
 import kube_api as api
 import rook as rook
+import concurrency as concurrency
+import transport as transport
+import scheduler as scheduler
+import snapshot as snapshot
+import ceph_model as ceph_model
+import epoch_cache as epoch_cache
+import tracing as tracing
 
 CRD_CEPH_CLUSTER = "CephCluster"
 
@@ -29,6 +36,77 @@ CONFIGMAP_MON_ENDPOINTS = "rook-ceph-mon-endpoints"
 CONFIGMAP_CONFIG_OVERRIDE = "rook-config-override"
 
 POD_TOOLBOX = "rook-ceph-tools"
+APP_MON = "rook-ceph-mon"
+
+# Ceph commands that only read cluster state. Concurrent identical calls of
+# these are coalesced into one toolbox exec.
+READ_ONLY_COMMANDS = [
+    ['status'], ['health'], ['fsid'], ['df'], ['quorum_status'],
+    ['mon', 'stat'], ['mon', 'dump'],
+    ['osd', 'stat'], ['osd', 'dump'], ['osd', 'tree'], ['osd', 'df'],
+    ['osd', 'pool', 'ls'], ['osd', 'pool', 'get'],
+    ['osd', 'pool', 'get-quota'],
+    ['osd', 'crush', 'dump'], ['osd', 'crush', 'tree'],
+    ['osd', 'crush', 'rule', 'dump'], ['osd', 'crush', 'rule', 'ls'],
+    ['pg', 'dump_stuck'],
+]
+
+# Commands scheduled ahead of everything else, and long running or heavy
+# commands scheduled after everything else. Others run as interactive, or
+# with the priority set by the caller through RookCephApi.priority().
+LIVENESS_COMMANDS = [
+    ['health'], ['fsid'], ['status'], ['quorum_status'], ['mon', 'stat'],
+]
+BULK_COMMANDS = [
+    ['osd', 'crush', 'dump'], ['osd', 'getcrushmap'], ['osd', 'setcrushmap'],
+    ['pg', 'dump'], ['pg', 'dump_stuck'],
+]
+
+# Reads of the cluster maps, kept in the on-disk snapshot and tagged with the
+# osdmap epoch (the crushmap is part of the osdmap).
+SNAPSHOT_COMMANDS = [
+    ['osd', 'tree'], ['osd', 'dump'], ['osd', 'pool', 'ls'],
+    ['osd', 'crush', 'dump'], ['osd', 'crush', 'tree'],
+    ['osd', 'crush', 'rule', 'dump'], ['osd', 'crush', 'rule', 'ls'],
+]
+
+# Reads whose output only changes with the epoch of a cluster map. Pools and
+# the crushmap are part of the osdmap.
+MAP_COMMANDS = {
+    epoch_cache.OSDMAP: SNAPSHOT_COMMANDS + [
+        ['osd', 'pool', 'get'], ['osd', 'pool', 'get-quota']],
+    epoch_cache.MONMAP: [['mon', 'dump']],
+}
+
+# Writes that can move the epoch of a map. Other writes (tell, config,
+# auth, ...) leave the probed epochs valid.
+MAP_WRITE_COMMANDS = {
+    epoch_cache.OSDMAP: [['osd']],
+    epoch_cache.MONMAP: [['mon']],
+}
+
+def map_of_cli(cli):
+    for map_name, commands in MAP_COMMANDS.items():
+        if match_cli(cli, commands):
+            return map_name
+    return None
+
+def osdmap_epoch(output):
+    # 'osd stat' nests the fields under 'osdmap' before Nautilus.
+    if not output:
+        return None
+    if 'osdmap' in output:
+        output = output['osdmap']
+    return output.get('epoch')
+
+def match_cli(cli, commands):
+    for prefix in commands:
+        if cli[:len(prefix)] == prefix:
+            return True
+    return False
+
+def is_read_only_cli(cli):
+    return match_cli(cli, READ_ONLY_COMMANDS)
 
 class ConfigDomain(enum.Enum):
     glb = 0
@@ -68,6 +146,15 @@ class CephConfigOperator(object):
             mon_data += ','
         return mon_data.strip(',')
 
+    def parse_configmap_mon_endpoints_data(self, mon_data):
+        mon_dict = {}
+        if not mon_data:
+            return mon_dict
+        for item in mon_data.split(','):
+            mon_list = item.split('=')
+            mon_dict[mon_list[0]] = mon_list[1]
+        return mon_dict
+
     def build_configmap_mon_endpoints_mapping(self, mons, map_dict):
         for key_m in list(map_dict["node"]):
             if key_m not in mons:
@@ -77,18 +164,155 @@ class CephConfigOperator(object):
 
 class RookCephOperator(rook.RookOperator):
 
-    def __init__(self, namespace):
+    def __init__(self, namespace, transports=None, snapshot_path=None,
+                 use_epoch_cache=True):
         self.name = 'python-rookclient-ceph'
         self.kube_op = api.KubeOperator(namespace)
         self.cfg_op = CephConfigOperator()
+        if transports is None:
+            transports = [transport.RadosTransport(),
+                          transport.LocalCliTransport(),
+                          transport.ToolboxTransport(self.kube_op, POD_TOOLBOX,
+                              find_pod=self.find_toolbox_pod)]
+        self.transports = transport.TransportSelector(transports)
+        # Locks for cluster state that is not a kubernetes object, e.g. the
+        # crushmap. Kubernetes objects are locked in kube_op.locks.
+        self.locks = concurrency.ResourceLocks()
+        self.single_flight = concurrency.SingleFlight()
+        self.scheduler = scheduler.CommandScheduler()
+        # Last osdmap epoch seen, the snapshot tag of map reads done after.
+        self._osdmap_epoch = None
+        self.epoch_cache = epoch_cache.EpochCache() if use_epoch_cache \
+            else None
+
+        self.snapshot = None
+        self.revalidator = None
+        if snapshot_path:
+            self.snapshot = snapshot.SnapshotStore(snapshot_path)
+            self.snapshot.load()
+            self.revalidator = snapshot.SnapshotRevalidator(self.snapshot,
+                self)
+            self.revalidator.start()
 
     def execute_toolbox_cli(self, cli, ceph_bin=True, sure=False,
                             format='json', timeout=None):
-        pod = self.kube_op.command_find_pod(POD_TOOLBOX)
-        if not pod:
-            print("Error when get pod rook-ceph-tools.")
-            return None
+        """
+        Run a CLI in the toolbox pod. Read-only ceph commands are coalesced:
+        callers issuing the same command at the same priority while one is
+        in flight share its output, so it must be treated as read-only by the
+        caller. Map reads
+        are also kept until the epoch of their map changes.
+        """
+        cli = list(cli)
+        with tracing.span('RookCephOperator.execute_toolbox_cli',
+                          {'ceph.command': " ".join(cli)}) as span:
+            if not ceph_bin or sure or not is_read_only_cli(cli):
+                output = self._execute_live(cli, ceph_bin, sure, format,
+                                            timeout)
+                if ceph_bin and self.epoch_cache is not None:
+                    for map_name, commands in MAP_WRITE_COMMANDS.items():
+                        if match_cli(cli, commands):
+                            # This may have moved the map, probe it again.
+                            self.epoch_cache.expire(map_name)
+                return output
+
+            map_name = map_of_cli(cli)
+            if self.epoch_cache is not None and map_name:
+                span.set_attribute('ceph.map', map_name)
+                return self.epoch_cache.fetch(map_name, (tuple(cli), format),
+                    self.probe_map_epoch,
+                    lambda: self._execute_map_read(cli, format, timeout))
+            return self._execute_map_read(cli, format, timeout)[0]
+
+    def execute_records(self, cli, field, record_cls, timeout=None):
+        """
+        Read a cluster map as a ceph_model.RecordList of record_cls over
+        output[field]. The epoch cache keeps the RecordList rather than the
+        decoded payload, so once its items are converted only the compact
+        records stay in memory. It is shared by all callers until the epoch
+        moves and must not be modified.
+        """
+        cli = list(cli)
+
+        def fetch():
+            output, live = self._execute_map_read(cli, 'json', timeout)
+            if not output:
+                return None, live
+            return ceph_model.RecordList(record_cls, output.get(field)), live
+
+        with tracing.span('RookCephOperator.execute_records',
+                          {'ceph.command': " ".join(cli)}):
+            map_name = map_of_cli(cli)
+            if self.epoch_cache is not None and map_name:
+                records = self.epoch_cache.fetch(map_name,
+                    (tuple(cli), record_cls.__name__), self.probe_map_epoch,
+                    fetch)
+            else:
+                records = fetch()[0]
+        if records is None:
+            return ceph_model.RecordList(record_cls, None)
+        return records
+
+    def _execute_map_read(self, cli, format, timeout):
+        """
+        Return (output, live), live is False when the output was served
+        from the snapshot and may be from an older epoch.
+        """
+        if (self.snapshot is not None and
+                match_cli(cli, SNAPSHOT_COMMANDS)):
+            key = snapshot.make_key(snapshot.CEPH, cli, format)
+            output = self.snapshot.get(key)
+            if output is not snapshot.MISS:
+                tracing.current_span().set_attribute('ceph.snapshot', True)
+                return output, False
+            epoch = self._osdmap_epoch
+            output = self._execute_live(cli, True, False, format, timeout)
+            if output is not None:
+                self.snapshot.put(key, output, epoch)
+            return output, True
+        return self._execute_live(cli, True, False, format, timeout), True
+
+    def probe_map_epoch(self, map_name):
+        if map_name == epoch_cache.OSDMAP:
+            return self.live_osdmap_epoch()
+        if map_name == epoch_cache.MONMAP:
+            output = self._execute_live(['mon', 'stat'])
+            return output.get('epoch') if output else None
+        return None
+
+    def _execute_live(self, cli, ceph_bin=True, sure=False, format='json',
+                      timeout=None):
+        output = self._execute_scheduled(cli, ceph_bin, sure, format, timeout)
+        if ceph_bin and list(cli) == ['osd', 'stat'] and output:
+            self._osdmap_epoch = osdmap_epoch(output)
+        return output
 
+    def _execute_scheduled(self, cli, ceph_bin, sure, format, timeout):
+        priority = self.cli_priority(cli, ceph_bin)
+        with tracing.span('RookCephOperator.schedule',
+                          {'scheduler.priority':
+                              scheduler.Priority(priority).name}):
+            if ceph_bin and not sure and is_read_only_cli(list(cli)):
+                # Only calls of the same priority share, so a read never
+                # waits on an in-flight one queued at a lower priority.
+                key = (tuple(cli), format, priority)
+                return self.single_flight.do(key, self.scheduler.run,
+                    priority, self._execute_toolbox_cli, cli, ceph_bin, sure,
+                    format, timeout)
+            return self.scheduler.run(priority, self._execute_toolbox_cli,
+                cli, ceph_bin, sure, format, timeout)
+
+    def cli_priority(self, cli, ceph_bin=True):
+        cli = list(cli)
+        if ceph_bin and match_cli(cli, LIVENESS_COMMANDS):
+            return scheduler.Priority.liveness
+        if not ceph_bin or match_cli(cli, BULK_COMMANDS):
+            default = scheduler.Priority.bulk
+        else:
+            default = scheduler.Priority.interactive
+        return self.scheduler.current_priority(default)
+
+    def _execute_toolbox_cli(self, cli, ceph_bin, sure, format, timeout):
         full_cli = []
         if ceph_bin:
             full_cli.append('ceph')
@@ -98,37 +322,118 @@ class RookCephOperator(rook.RookOperator):
         if format == 'json':
             full_cli.extend(['--format', 'json-pretty'])
 
+        # crushtool and -i/-o work on files inside the toolbox pod, they can
+        # only run there.
+        only = None
+        if not ceph_bin or '-i' in cli or '-o' in cli:
+            only = transport.ToolboxTransport.name
+
         full_cli_str = " ".join(full_cli)
-        print("FULL CLI STRING ------> %s" % full_cli_str)
-        output = self.kube_op.command_execute_cli(pod, full_cli_str, timeout)
+        tracing.current_span().set_attribute('ceph.cli', full_cli_str)
+        try:
+            output = self.transports.execute(full_cli, timeout, only=only)
+        except transport.TransportError as e:
+            print("Error when execute cli %s: %s" % (full_cli_str, e))
+            return None
         return output
 
-    def get_rook_mon_count(self):
-        cluster_crd = self.kube_op.command_find_resource(CRD_CEPH_CLUSTER)
+    '''
+    Snapshot, reads served from the on-disk snapshot while it warms up and
+    the hooks used by snapshot.SnapshotRevalidator.
+    '''
+
+    def _snapshot_read(self, key, fetch, tag_of, cached=True):
+        if self.snapshot is None:
+            return fetch()
+        if cached:
+            value = self.snapshot.get(key)
+            if value is not snapshot.MISS:
+                return value
+        value = fetch()
+        if value:
+            self.snapshot.put(key, value, tag_of(value))
+        return value
+
+    def _resource_version(self, objects):
+        return objects.get('metadata', {}).get('resourceVersion')
+
+    # Pod and resource names are always looked up live: after a reboot or
+    # an upgrade the pod of the snapshot is gone, and every command sent to
+    # it, the revalidation included, would fail.
+    def find_toolbox_pod(self):
+        return self.kube_op.command_find_pod(POD_TOOLBOX)
+
+    def find_cluster_crd(self):
+        return self.kube_op.command_find_resource(CRD_CEPH_CLUSTER)
+
+    def get_resource(self, resource, name, cached=True):
+        return self._snapshot_read(snapshot.make_key(snapshot.KUBE, resource,
+            name), lambda: self.kube_op.command_get(resource, name),
+            self._resource_version, cached=cached)
+
+    def live_fsid(self):
+        output = self._execute_live(['fsid'])
+        if not output:
+            return None
+        return self.kube_op.get_object_value(output, 'fsid')
+
+    def live_osdmap_epoch(self):
+        return osdmap_epoch(self._execute_live(['osd', 'stat']))
+
+    def current_tag(self, key):
+        key = snapshot.parse_key(key)
+        kind, args = key[0], key[1:]
+        if kind == snapshot.KUBE:
+            return self.kube_op.command_resource_version(*args)
+        return None
+
+    def refresh(self, key):
+        key = snapshot.parse_key(key)
+        kind, args = key[0], key[1:]
+        if kind == snapshot.CEPH:
+            epoch = self._osdmap_epoch
+            return self._execute_live(args[0], format=args[1]), epoch
+        if kind == snapshot.KUBE:
+            objects = self.kube_op.command_get(*args)
+            return objects, self._resource_version(objects)
+        raise ValueError("unknown snapshot key %s" % key)
+
+    def get_rook_mon_count(self, cached=True):
+        cluster_crd = self.find_cluster_crd()
         if not cluster_crd:
             print("Error when find resource: %s." % CRD_CEPH_CLUSTER)
             return 0
 
-        objects = self.kube_op.command_get(CRD_CEPH_CLUSTER, cluster_crd)
+        objects = self.get_resource(CRD_CEPH_CLUSTER, cluster_crd, cached)
         return self.kube_op.get_object_value(objects, 'spec.mon.count')
 
-    def get_rook_mon_list(self):
-        objects = self.kube_op.command_get('configmap', CONFIGMAP_MON_ENDPOINTS)
+    def get_rook_mon_list(self, cached=True):
+        objects = self.get_resource('configmap', CONFIGMAP_MON_ENDPOINTS,
+            cached)
         mon_data = self.kube_op.get_object_value(objects, 'data.data')
-        mon_list = []
-        mon_dict = {}
-
-        if not mon_data:
-            return mon_dict
-
-        for item in mon_data.split(','):
-            mon_list = item.split('=')
-            mon_dict[mon_list[0]] = mon_list[1]
-        print(mon_dict)
+        mon_dict = self.cfg_op.parse_configmap_mon_endpoints_data(mon_data)
+        if mon_dict:
+            print(mon_dict)
         return mon_dict
 
+    def get_running_mon_pods(self, timeout=None):
+        objects = self.kube_op.command_list('pod', selector='app=%s' % APP_MON,
+            timeout=timeout)
+        pods = []
+        if not objects:
+            return pods
+
+        for item in objects.get('items') or []:
+            status = item.get('status', {})
+            if status.get('phase') != 'Running':
+                continue
+            containers = status.get('containerStatuses') or []
+            if all(c.get('ready') for c in containers):
+                pods.append(item['metadata']['name'])
+        return sorted(pods)
+
     def modify_rook_mon_count(self, count, timeout=None):
-        cluster_crd = self.kube_op.command_find_resource(CRD_CEPH_CLUSTER)
+        cluster_crd = self.find_cluster_crd()
         if not cluster_crd:
             print("Error when find resource: %s." % CRD_CEPH_CLUSTER)
             return
@@ -153,39 +458,58 @@ class RookCephOperator(rook.RookOperator):
             'rook-config-override', 'data.config', mons_hosts)
         '''
 
-        mon_count = self.get_rook_mon_count()
-        if mon_count >= 1 and mon_count < 3:
-            mon_count += 1
-            self.modify_rook_mon_count(mon_count, timeout)
+        self.step_rook_mon_count(1, timeout)
+
+    def step_rook_mon_count(self, step, timeout=None):
+        # The mon count is bounded to [1, 3]. The new count is computed from
+        # the CephCluster read by each attempt, so concurrent add/remove
+        # requests and the rook operator do not lose an update.
+        cluster_crd = self.find_cluster_crd()
+        if not cluster_crd:
+            print("Error when find resource: %s." % CRD_CEPH_CLUSTER)
+            return False
+
+        def mutate(objects):
+            mon_count = self.kube_op.get_object_value(objects,
+                'spec.mon.count')
+            if not (1 <= mon_count <= 3 and 1 <= mon_count + step <= 3):
+                return False
+            self.kube_op.set_object_value(objects, 'spec.mon.count',
+                mon_count + step)
+
+        return self.kube_op.update_resource_object(CRD_CEPH_CLUSTER,
+            cluster_crd, mutate, timeout)
 
 
     def remove_dedicated_ceph_mon(self, mon_id, timeout=None):
-        # remove the ceph monitor with id
-        mons = self.get_rook_mon_list()
-        if mon_id not in mons:
-            print("Error when remove dedicated mon: mon_id: %s cannot find." %
-                mon_id)
+        # remove the ceph monitor with id, the endpoints and the mapping are
+        # both computed from the configmap read by each attempt and written
+        # in one replace.
+        def mutate(objects):
+            mons = self.cfg_op.parse_configmap_mon_endpoints_data(
+                self.kube_op.get_object_value(objects, 'data.data'))
+            if mon_id not in mons:
+                print("Error when remove dedicated mon: mon_id: %s cannot find." %
+                    mon_id)
+                return False
+
+            mons.pop(mon_id)
+
+            mons_hosts = self.cfg_op.build_configmap_mon_endpoints_data(mons)
+            self.kube_op.set_object_value(objects, 'data.data', mons_hosts)
+
+            mon_dict = json.loads(self.kube_op.get_object_value(objects,
+                'data.mapping'))
+            mon_dict = self.cfg_op.build_configmap_mon_endpoints_mapping(mons,
+                mon_dict)
+            self.kube_op.set_object_value(objects, 'data.mapping',
+                json.dumps(mon_dict))
+
+        if not self.kube_op.update_resource_object('configmap',
+                CONFIGMAP_MON_ENDPOINTS, mutate, timeout):
             return False
-        
-        mons.pop(mon_id)
-
-        mons_hosts = self.cfg_op.build_configmap_mon_endpoints_data(mons)
-        self.kube_op.override_resource_object('configmap',
-            CONFIGMAP_MON_ENDPOINTS, 'data.data', mons_hosts)
-        
-        mon_mapping = self.kube_op.fetch_resource_object('configmap',
-            CONFIGMAP_MON_ENDPOINTS, 'data.mapping')
-        mon_dict = json.loads(mon_mapping)
-        mon_dict = self.cfg_op.build_configmap_mon_endpoints_mapping(mons,
-            mon_dict)
-        mon_mapping = json.dumps(mon_dict)
-        self.kube_op.override_resource_object('configmap',
-            CONFIGMAP_MON_ENDPOINTS, 'data.mapping', mon_mapping)
-
-        mon_count = self.get_rook_mon_count()
-        if mon_count > 1 and mon_count <= 3:
-            mon_count -= 1
-            self.modify_rook_mon_count(mon_count, timeout)
+
+        self.step_rook_mon_count(-1, timeout)
         '''
         self.execute_toolbox_cli('ceph mon rm %s'%mon_id, namespace=namespace)
 
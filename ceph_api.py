@@ -21,12 +21,52 @@ import time
 import sys
 import shutil
 import json
+import capacity as capacity
 import ceph as ceph
+import ceph_model as ceph_model
+import convergence as convergence
+import kube_api as kube_api
+import perf_counters as perf_counters
+import pg_planner as pg_planner
+import tracing as tracing
 
 
 class RookCephApi(object):
-    def __init__(self, namespace):
-        self.ceph_op = ceph.RookCephOperator(namespace)
+    """
+    Concurrency model: one RookCephApi can be shared by many threads or
+    greenthreads.
+
+    - Get interfaces keep no per-call state in the client and take no
+      lock. Identical reads issued at the same time and priority share one
+      toolbox exec and the same decoded output, which callers must not
+      modify.
+    - Read-modify-write of a kubernetes object (CephCluster CR, mon-endpoints
+      configmap) holds the lock of that object and replaces it with the
+      resourceVersion it read. On apiserver conflicts it reads the object
+      again and recomputes the change from it.
+    - Writes to the crushmap hold the 'crushmap' lock. Callers that edit the
+      crushmap in several steps (get, decompile, compile, set) should hold
+      crushmap_lock() across the whole sequence.
+    - Reads of the cluster maps (osd tree, crush dump/tree, pools, mon dump)
+      return the output parsed earlier while the map epoch is unchanged, so
+      it is shared between calls and must not be modified.
+    - With a snapshot, reads right after start may come from disk until the
+      background revalidation ends; read-modify-write paths always read
+      live state.
+    - All commands, reads included, pass the priority scheduler of the
+      operator: at most 8 run at a time and, except liveness checks
+      (health, fsid, status), they are rate limited to 10 per second, so a
+      read may queue behind other commands. Liveness checks are admitted
+      first, then interactive calls, then background work such as the
+      capacity sampler and perf counter collection (audit).
+    """
+
+    def __init__(self, namespace, transports=None, snapshot_path=None,
+                 use_epoch_cache=True):
+        self.ceph_op = ceph.RookCephOperator(namespace, transports=transports,
+            snapshot_path=snapshot_path, use_epoch_cache=use_epoch_cache)
+        self.waiter = convergence.ConvergenceWaiter(self.ceph_op.kube_op)
+        self.capacity_sampler = None
         self.is_ready = False
 
     '''
@@ -88,6 +128,12 @@ class RookCephApi(object):
             timeout=timeout)
         return output
 
+    def osd_pool_ls_detail(self, timeout=None):
+        output = self.ceph_op.execute_toolbox_cli(
+            ['osd', 'pool', 'ls', 'detail'],
+            timeout=timeout)
+        return output
+
     def osd_crush_dump(self, timeout=None):
         output = self.ceph_op.execute_toolbox_cli(['osd', 'crush', 'dump'],
             timeout=timeout)
@@ -101,29 +147,26 @@ class RookCephApi(object):
         return output
 
     def get_tiers_size(self, timeout=None):
-        output = self.osd_df(self, timeout=timeout)
-        search_tree = {}
-        for node in output['nodes']:
-            search_tree[node['id']] = node
+        search_tree = self.osd_df_nodes(timeout=timeout).by_id()
 
         # Extract the tiers as we will return a dict for the size of each tier
-        tiers = {k: v for k, v in search_tree.items() if v['type'] == 'root'}
+        tiers = {k: v for k, v in search_tree.items() if v.type == 'root'}
 
         # For each tier, traverse the heirarchy from the root->chassis->host.
         # Sum the host sizes to determine the overall size of the tier
         tier_sizes = {}
         for tier in tiers.values():
             tier_size = 0
-            for chassis_id in tier['children']:
+            for chassis_id in tier.children:
                 chassis_size = 0
                 chassis = search_tree[chassis_id]
-                for host_id in chassis['children']:
+                for host_id in chassis.children:
                     host = search_tree[host_id]
                     if (chassis_size == 0 or
-                            chassis_size > host['kb']):
-                        chassis_size = host['kb']
+                            chassis_size > host.kb):
+                        chassis_size = host.kb
                 tier_size += chassis_size / (1024**2)
-            tier_sizes[tier['name']] = tier_size
+            tier_sizes[tier.name] = tier_size
 
         return tier_sizes
 
@@ -159,6 +202,19 @@ class RookCephApi(object):
             timeout=timeout)
         return output
 
+    def daemon_perf_dump(self, daemon, timeout=None):
+        output = self.ceph_op.execute_toolbox_cli(
+            ['tell', daemon, 'perf', 'dump'],
+            timeout=timeout)
+        return output
+
+    def collect_perf_counters(self, daemon_types=('osd', 'mon'),
+                              max_workers=perf_counters.MAX_WORKERS,
+                              rate=perf_counters.RATE, timeout=None):
+        collector = perf_counters.PerfCollector(self, max_workers=max_workers,
+            rate=rate)
+        return collector.collect(daemon_types=daemon_types, timeout=timeout)
+
     #def pg_dump_stuck(self, stuckops=None, threshold=None, timeout=None):
     def pg_dump_stuck(self, timeout=None):
         output = self.ceph_op.execute_toolbox_cli(
@@ -166,6 +222,57 @@ class RookCephApi(object):
             timeout=timeout)
         return output
 
+    '''
+    Record Interfaces, the same queries as above returned as compact
+    ceph_model records instead of the raw decoded dicts. Map reads keep the
+    records, not the dicts, in the epoch cache.
+    '''
+
+    def osd_tree_nodes(self, timeout=None):
+        return self.ceph_op.execute_records(['osd', 'tree'], 'nodes',
+            ceph_model.OsdNode, timeout=timeout)
+
+    def osd_df_nodes(self, timeout=None):
+        output = self.osd_df(timeout=timeout)
+        if not output:
+            return ceph_model.RecordList(ceph_model.OsdNode, None)
+        return ceph_model.RecordList(ceph_model.OsdNode, output['nodes'])
+
+    def ceph_df_pools(self, timeout=None):
+        output = self.ceph_df(timeout=timeout)
+        if not output:
+            return ceph_model.RecordList(ceph_model.PoolStats, None)
+        return ceph_model.RecordList(ceph_model.PoolStats, output['pools'])
+
+    def pg_dump_stuck_stats(self, timeout=None):
+        output = self.pg_dump_stuck(timeout=timeout)
+        # Newer releases wrap the list, older ones return it directly.
+        if isinstance(output, dict):
+            output = output.get('stuck_pg_stats')
+        if not isinstance(output, list):
+            output = None
+        return ceph_model.RecordList(ceph_model.PgStat, output)
+
+    def osd_crush_buckets(self, timeout=None):
+        return self.ceph_op.execute_records(['osd', 'crush', 'dump'],
+            'buckets', ceph_model.CrushBucket, timeout=timeout)
+
+    def plan_pg_changes(self, pools, healthy=True,
+                        target_pgs_per_osd=pg_planner.TARGET_PGS_PER_OSD,
+                        timeout=None):
+        """
+        Plan pg_num/pgp_num changes for all pools of all tiers from one osd
+        tree and one pool listing, see pg_planner.PgPlanner.targets for the
+        format of pools. Apply the changes with osd_pool_set_param.
+        """
+        topology = pg_planner.tier_topology(self.osd_tree_nodes(timeout))
+        current = {}
+        for pool in self.osd_pool_ls_detail(timeout) or []:
+            current[pool['pool_name']] = dict(pg_num=pool['pg_num'],
+                pgp_num=pool['pg_placement_num'], size=pool['size'])
+        planner = pg_planner.PgPlanner(target_pgs_per_osd=target_pgs_per_osd)
+        return planner.plan(topology, pools, current, healthy=healthy)
+
     def _osd_crush_rule_by_ruleset(self, ruleset, timeout=None):
         output = self.osd_crush_rule_dump(timeout=timeout)
         name = None
@@ -176,6 +283,133 @@ class RookCephApi(object):
         output = dict(rule=name)
         return output
 
+    '''
+    Snapshot, with snapshot_path set the cluster maps and rook resources read
+    through the client are kept on disk and served right after a restart
+    while they are revalidated in the background.
+    '''
+
+    def save_snapshot(self):
+        if self.ceph_op.snapshot is None:
+            return 0
+        return self.ceph_op.snapshot.save()
+
+    '''
+    Scheduling, commands are admitted by priority (see scheduler.Priority)
+    under a concurrency cap and a rate limit. budget() lets the commands of
+    a block take their tokens from their own scheduler.TokenBucket.
+    '''
+
+    def priority(self, priority):
+        return self.ceph_op.scheduler.priority(priority)
+
+    def budget(self, bucket):
+        return self.ceph_op.scheduler.budget(bucket)
+
+    def scheduler_metrics(self):
+        return self.ceph_op.scheduler.metrics()
+
+    '''
+    Tracing, off by default. When enabled every call below is traced down
+    to the transport and kubectl processes, and calls slower than
+    slow_threshold seconds are kept in a ring log of slow_log_size entries,
+    except the waits, perf counter collection and pg planning which are slow
+    by design. A span keeps at most max_children children. The tracer is shared by all RookCephApi instances of the process.
+    '''
+
+    def enable_tracing(self, slow_threshold=tracing.SLOW_THRESHOLD,
+                       slow_log_size=tracing.SLOW_LOG_SIZE,
+                       use_opentelemetry=False,
+                       max_children=tracing.MAX_CHILDREN):
+        tracing.enable(slow_threshold, slow_log_size, use_opentelemetry,
+                       max_children)
+
+    def disable_tracing(self):
+        tracing.disable()
+
+    def slow_calls(self, clear=False):
+        return tracing.get_tracer().slow_calls(clear)
+
+    def dump_slow_calls(self, clear=False):
+        print(tracing.get_tracer().format_slow_calls(clear))
+
+    '''
+    Capacity sampling, ceph df/osd df polled every interval seconds on a
+    background thread, keeping the last size samples. Read the samples from
+    self.capacity_sampler (see capacity.CapacitySampler).
+    '''
+
+    def start_capacity_sampler(self, interval=60, size=1440):
+        if self.capacity_sampler is None:
+            self.capacity_sampler = capacity.CapacitySampler(self,
+                interval=interval, capacity=size)
+        self.capacity_sampler.start()
+        return self.capacity_sampler
+
+    def stop_capacity_sampler(self, timeout=None):
+        if self.capacity_sampler is not None:
+            self.capacity_sampler.stop(timeout)
+
+    '''
+    Wait Interfaces, block until the cluster converges on a state or the
+    timeout (seconds) expires. They return True when converged and False on
+    timeout.
+    '''
+
+    def _check(self, func):
+        def check():
+            try:
+                return func()
+            except (kube_api.ApiError, KeyError, TypeError, ValueError):
+                # The cluster is in transition, e.g. a mon is restarting.
+                return False, None
+        return check
+
+    def wait_for_mon_count(self, count, timeout=300):
+        def mon_count():
+            pods = self.ceph_op.get_running_mon_pods()
+            endpoints = sorted(self.ceph_op.get_rook_mon_list(cached=False))
+            quorum = sorted(self.quorum_status()['quorum_names'])
+            done = (len(pods) == count and len(endpoints) == count and
+                    len(quorum) == count)
+            return done, (pods, endpoints, quorum)
+
+        return self.waiter.wait(self._check(mon_count), timeout, watches=[
+            ('pod', None, 'app=%s' % ceph.APP_MON),
+            ('configmap', ceph.CONFIGMAP_MON_ENDPOINTS, None)])
+
+    def wait_for_quorum(self, contains=None, omits=None, timeout=300):
+        def quorum():
+            names = sorted(self.quorum_status()['quorum_names'])
+            done = ((contains is None or contains in names) and
+                    (omits is None or omits not in names))
+            return done, names
+
+        return self.waiter.wait(self._check(quorum), timeout, watches=[
+            ('pod', None, 'app=%s' % ceph.APP_MON)])
+
+    def wait_for_pool(self, pool, pg_num=None, timeout=300):
+        def pool_ready():
+            value = self.osd_pool_get(pool, 'pg_num')
+            if value is None:
+                return False, None
+            return pg_num is None or value == pg_num, value
+
+        return self.waiter.wait(self._check(pool_ready), timeout)
+
+    def wait_for_health_ok(self, timeout=600):
+        def health_ok():
+            # Recovery progress shows up in the pg states before the health
+            # checks clear, so both are part of the progress token.
+            output = self.status()
+            status = output['health']['status']
+            checks = sorted((output['health'].get('checks') or {}).keys())
+            pgs = sorted((item['state_name'], item['count']) for item in
+                         output.get('pgmap', {}).get('pgs_by_state', []))
+            return status == 'HEALTH_OK', (status, checks, pgs)
+
+        return self.waiter.wait(self._check(health_ok), timeout)
+
     '''
     Set Interfaces
     '''
@@ -335,46 +569,52 @@ class RookCephApi(object):
 
     # Toolbox CLI
     def osd_crush_remove(self, osdid_str, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'rm', osdid_str],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'rm', osdid_str],
+                timeout=timeout)
         return output
 
     # Toolbox CLI
     # ceph osd crush move osd.1 host=controller-0
     def osd_crush_move(self, name, args, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'move', name, args],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'move', name, args],
+                timeout=timeout)
         return output
 
     # Toolbox CLI
     # ceph osd crush rule create-replicated replicated_rule default host
     def osd_crush_rule_rm(self, name, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'rule', 'rm', name],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'rule', 'rm', name],
+                timeout=timeout)
         return output
 
     # Toolbox CLI
     def osd_crush_rule_rename(self, srcname, dstname, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'rule', 'rename', srcname, dstname],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'rule', 'rename', srcname, dstname],
+                timeout=timeout)
         return output
 
     # Toolbox CLI
     def osd_crush_add_bucket(self, name, _type, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'add-bucket', name, _type],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'add-bucket', name, _type],
+                timeout=timeout)
         return output
 
     # Toolbox CLI
     def osd_crush_rename_bucket(self, srcname, dstname, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'crush', 'rename-bucket', srcname, dstname],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'crush', 'rename-bucket', srcname, dstname],
+                timeout=timeout)
         return output
 
 
@@ -382,29 +622,42 @@ class RookCephApi(object):
     CRUSHMAP get/set/dump/compile
     '''
 
+    def crushmap_lock(self):
+        return self.ceph_op.locks.hold('crushmap')
+
     def osd_crushmap_get(self, crushmap_bin_file, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'getcrushmap', '-o', crushmap_bin_file],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'getcrushmap', '-o', crushmap_bin_file],
+                timeout=timeout)
         return output
 
     def osd_crushmap_set(self, crushmap_bin_file, timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['osd', 'setcrushmap', '-i', crushmap_bin_file],
-            timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['osd', 'setcrushmap', '-i', crushmap_bin_file],
+                timeout=timeout)
         return output
 
     def osd_crushmap_compile(self, crushmap_txt_file, crushmap_bin_file,
                              timeout=None):
-        output = self.ceph_op.execute_toolbox_cli(
-            ['crushtool', '-c', crushmap_txt_file, '-o', crushmap_bin_file],
-            ceph_bin=False, timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['crushtool', '-c', crushmap_txt_file, '-o', crushmap_bin_file],
+                ceph_bin=False, timeout=timeout)
         return output
 
     def osd_crushmap_decompile(self, crushmap_bin_file, crushmap_txt_file,
                                timeout=None):
-
-        output = self.ceph_op.execute_toolbox_cli(
-            ['crushtool', '-d', crushmap_bin_file, '-o', crushmap_txt_file],
-            ceph_bin=False, timeout=timeout)
+        with self.crushmap_lock():
+            output = self.ceph_op.execute_toolbox_cli(
+                ['crushtool', '-d', crushmap_bin_file, '-o', crushmap_txt_file],
+                ceph_bin=False, timeout=timeout)
         return output
+
+
+tracing.instrument(RookCephApi, exclude=('crushmap_lock', 'priority',
+    'budget', 'scheduler_metrics', 'enable_tracing', 'disable_tracing', 'slow_calls',
+    'dump_slow_calls'), long_running=('collect_perf_counters',
+    'plan_pg_changes', 'wait_for_mon_count', 'wait_for_quorum',
+    'wait_for_pool', 'wait_for_health_ok'))
@@ -0,0 +1,262 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Compact record classes for the toolbox CLI payloads.
+
+The decoded YAML/JSON payloads are kept as nested dicts by RookCephApi. On
+large clusters those dicts are the dominant memory cost, so the classes below
+hold the same fields in __slots__ and keep id lists in array.array. Records
+are built lazily: RecordList wraps the raw list and converts an item the
+first time it is accessed.
+"""
+
+import array
+import sys
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+
+def _intern(value):
+    # Type names, states and device classes repeat across every record.
+    if value is None:
+        return None
+    return sys.intern(str(value))
+
+
+def _int_array(values):
+    return array.array('i', values or ())
+
+
+class Record(object):
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        raise NotImplementedError
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key)
+                   for key in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (key, getattr(self, key)) for key in self.__slots__))
+
+
+class OsdNode(Record):
+    """
+    A node of 'osd tree' or 'osd df tree': either an osd or a crush bucket.
+    The usage fields are only filled in for 'osd df' payloads.
+    """
+    __slots__ = ('id', 'name', 'type', 'type_id', 'children', 'status',
+                 'device_class', 'crush_weight', 'reweight', 'kb',
+                 'kb_used', 'kb_avail', 'utilization', 'pgs')
+
+    def __init__(self, id, name, type, type_id=0, children=None,
+                 status=None, device_class=None, crush_weight=0.0,
+                 reweight=0.0, kb=0, kb_used=0, kb_avail=0,
+                 utilization=0.0, pgs=0):
+        self.id = id
+        self.name = name
+        self.type = _intern(type)
+        self.type_id = type_id
+        self.children = _int_array(children)
+        self.status = _intern(status)
+        self.device_class = _intern(device_class)
+        self.crush_weight = crush_weight
+        self.reweight = reweight
+        self.kb = kb
+        self.kb_used = kb_used
+        self.kb_avail = kb_avail
+        self.utilization = utilization
+        self.pgs = pgs
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['name'], data['type'],
+                   type_id=data.get('type_id', 0),
+                   children=data.get('children'),
+                   status=data.get('status'),
+                   device_class=data.get('device_class'),
+                   crush_weight=data.get('crush_weight', 0.0),
+                   reweight=data.get('reweight', 0.0),
+                   kb=data.get('kb', 0),
+                   kb_used=data.get('kb_used', 0),
+                   kb_avail=data.get('kb_avail', 0),
+                   utilization=data.get('utilization', 0.0),
+                   pgs=data.get('pgs', 0))
+
+    def to_dict(self):
+        data = super(OsdNode, self).to_dict()
+        data['children'] = list(self.children)
+        return data
+
+    @property
+    def is_osd(self):
+        return self.type == 'osd'
+
+
+class PoolStats(Record):
+    """
+    A pool entry of 'ceph df'.
+    """
+    __slots__ = ('id', 'name', 'bytes_used', 'kb_used', 'stored',
+                 'max_avail', 'objects', 'percent_used')
+
+    def __init__(self, id, name, bytes_used=0, kb_used=0, stored=0,
+                 max_avail=0, objects=0, percent_used=0.0):
+        self.id = id
+        self.name = name
+        self.bytes_used = bytes_used
+        self.kb_used = kb_used
+        self.stored = stored
+        self.max_avail = max_avail
+        self.objects = objects
+        self.percent_used = percent_used
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = data.get('stats', {})
+        bytes_used = stats.get('bytes_used', 0)
+        return cls(data['id'], data['name'],
+                   bytes_used=bytes_used,
+                   kb_used=stats.get('kb_used', bytes_used // 1024),
+                   stored=stats.get('stored', bytes_used),
+                   max_avail=stats.get('max_avail', 0),
+                   objects=stats.get('objects', 0),
+                   percent_used=stats.get('percent_used', 0.0))
+
+
+class PgStat(Record):
+    """
+    A placement group entry of 'pg dump_stuck'.
+    """
+    __slots__ = ('pgid', 'state', 'up', 'acting', 'up_primary',
+                 'acting_primary')
+
+    def __init__(self, pgid, state, up=None, acting=None, up_primary=-1,
+                 acting_primary=-1):
+        self.pgid = pgid
+        self.state = _intern(state)
+        self.up = _int_array(up)
+        self.acting = _int_array(acting)
+        self.up_primary = up_primary
+        self.acting_primary = acting_primary
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['pgid'], data['state'],
+                   up=data.get('up'),
+                   acting=data.get('acting'),
+                   up_primary=data.get('up_primary', -1),
+                   acting_primary=data.get('acting_primary', -1))
+
+    def to_dict(self):
+        data = super(PgStat, self).to_dict()
+        data['up'] = list(self.up)
+        data['acting'] = list(self.acting)
+        return data
+
+
+class CrushBucket(Record):
+    """
+    A bucket of 'osd crush dump'. The bucket items are kept as two parallel
+    arrays, item_ids and item_weights, instead of a list of dicts.
+    """
+    __slots__ = ('id', 'name', 'type_id', 'type_name', 'weight', 'alg',
+                 'hash', 'item_ids', 'item_weights')
+
+    def __init__(self, id, name, type_id, type_name, weight=0, alg=None,
+                 hash=None, items=None):
+        self.id = id
+        self.name = name
+        self.type_id = type_id
+        self.type_name = _intern(type_name)
+        self.weight = weight
+        self.alg = _intern(alg)
+        self.hash = _intern(hash)
+        items = items or ()
+        self.item_ids = _int_array([item['id'] for item in items])
+        self.item_weights = array.array(
+            'l', [item.get('weight', 0) for item in items])
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['name'], data['type_id'],
+                   data['type_name'],
+                   weight=data.get('weight', 0),
+                   alg=data.get('alg'),
+                   hash=data.get('hash'),
+                   items=data.get('items'))
+
+    def to_dict(self):
+        data = dict((key, getattr(self, key)) for key in
+                    ('id', 'name', 'type_id', 'type_name', 'weight', 'alg',
+                     'hash'))
+        data['items'] = [dict(id=i, weight=w, pos=pos) for pos, (i, w) in
+                         enumerate(zip(self.item_ids, self.item_weights))]
+        return data
+
+
+class RecordList(Sequence):
+    """
+    Read-only sequence over a decoded payload list. Items are converted to
+    record_cls on first access and the raw dict reference is dropped.
+    """
+
+    def __init__(self, record_cls, raw):
+        self._record_cls = record_cls
+        self._items = list(raw or ())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self._items[index]
+        if isinstance(item, dict):
+            item = self._record_cls.from_dict(item)
+            self._items[index] = item
+        return item
+
+    def __repr__(self):
+        return '%s(%s, %d items)' % (type(self).__name__,
+                                     self._record_cls.__name__, len(self))
+
+    def by_id(self, key='id'):
+        return dict((getattr(item, key), item) for item in self)
+
+    def to_dicts(self):
+        return [item.to_dict() for item in self]
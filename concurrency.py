@@ -0,0 +1,105 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Synchronization helpers shared by the kube and ceph operators.
+
+Only the threading module is used, so the locks also serialize greenthreads
+when the caller runs with eventlet monkey patching (as sysinv does).
+"""
+
+import contextlib
+import threading
+
+
+class ResourceLocks(object):
+    """
+    A registry of re-entrant locks, one per resource key. Writers to the same
+    resource queue on its lock, writers to different resources and all
+    readers run concurrently.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def get(self, *key):
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = threading.RLock()
+                self._locks[key] = lock
+            return lock
+
+    @contextlib.contextmanager
+    def hold(self, *key):
+        lock = self.get(*key)
+        with lock:
+            yield
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it is in flight wait for it and get the
+    same result (or the same exception). Nothing is kept once the call
+    returns, so this is independent of any result caching.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
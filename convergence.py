@@ -0,0 +1,153 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Wait for the Rook operator and ceph to converge on a requested state.
+
+A wait re-evaluates its check as soon as one of its kubernetes watches
+reports a change. Between changes it polls with a backoff that resets
+whenever the check observes progress (its progress token changed) and
+doubles while the cluster stands still, bounded by an overall deadline.
+"""
+
+import os
+import signal
+import threading
+import time
+
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 8.0
+
+
+class ResourceWatch(object):
+    """
+    Run a kubectl watch in the background and set the event on every change.
+    If the watch process ends early the wait falls back to polling.
+    """
+
+    def __init__(self, kube_op, event, resource, name=None, selector=None):
+        self._kube_op = kube_op
+        self._event = event
+        self._resource = resource
+        self._name = name
+        self._selector = selector
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        try:
+            self._process = self._kube_op.command_watch(self._resource,
+                name=self._name, selector=self._selector)
+        except OSError as e:
+            print("Fail to watch resource %s: %s." % (self._resource, e))
+            return
+        self._thread = threading.Thread(target=self._read,
+            name='rookclient-watch-%s' % self._resource)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        for line in self._process.stdout:
+            if line.strip():
+                self._event.set()
+
+    def _signal_group(self, sig):
+        try:
+            os.killpg(self._process.pid, sig)
+        except OSError:
+            pass
+
+    def terminate(self):
+        """
+        Signal the whole process group, so descendants holding the pipe go
+        as well and the reader sees EOF.
+        """
+        if self._process is not None and self._process.poll() is None:
+            self._signal_group(signal.SIGTERM)
+
+    def close(self):
+        if self._process is None:
+            return
+        try:
+            self._process.wait(timeout=1)
+        except Exception:
+            self._signal_group(signal.SIGKILL)
+            self._process.wait()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            if self._thread.is_alive():
+                self._signal_group(signal.SIGKILL)
+                self._thread.join()
+            self._thread = None
+        self._process.stdout.close()
+        self._process = None
+
+    def stop(self):
+        self.terminate()
+        self.close()
+
+
+class ConvergenceWaiter(object):
+
+    def __init__(self, kube_op, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL):
+        self.kube_op = kube_op
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def wait(self, check, timeout, watches=None):
+        """
+        Wait until check() reports done or the timeout (seconds) expires.
+
+        check returns a tuple (done, token). token is any comparable value
+        that describes the observed state; a change of token counts as
+        progress and resets the poll interval.
+        watches is a list of (resource, name, selector) to watch.
+        Returns True when converged, False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        changed = threading.Event()
+        running = [ResourceWatch(self.kube_op, changed, *watch)
+                   for watch in (watches or [])]
+        for watch in running:
+            watch.start()
+
+        try:
+            interval = self.min_interval
+            last_token = None
+            while True:
+                changed.clear()
+                done, token = check()
+                if done:
+                    return True
+
+                if token != last_token:
+                    interval = self.min_interval
+                    last_token = token
+                else:
+                    interval = min(interval * 2, self.max_interval)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                changed.wait(min(interval, remaining))
+        finally:
+            # Signal every watch first, so they all exit together.
+            for watch in running:
+                watch.terminate()
+            for watch in running:
+                watch.close()
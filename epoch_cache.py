@@ -0,0 +1,103 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Keep parsed cluster map reads until the map epoch moves.
+
+Every read of a map ('osd tree', 'osd crush dump', ...) first asks for the
+current epoch of its map with a small query ('osd stat', 'mon stat'). When
+the epoch is the one the cached output was fetched at, the cached output is
+returned; otherwise the map is fetched in full again. Epoch probes are reused
+for probe_ttl seconds so a burst of reads costs one probe per map.
+"""
+
+import threading
+import time
+
+OSDMAP = 'osdmap'
+MONMAP = 'monmap'
+
+PROBE_TTL = 1.0
+
+
+class EpochCache(object):
+
+    def __init__(self, probe_ttl=PROBE_TTL):
+        self.probe_ttl = probe_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._probes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def current_epoch(self, map_name, probe):
+        with self._lock:
+            cached = self._probes.get(map_name)
+            if cached is not None and time.time() - cached[1] < self.probe_ttl:
+                return cached[0]
+        epoch = probe(map_name)
+        if epoch is not None:
+            with self._lock:
+                self._probes[map_name] = (epoch, time.time())
+        return epoch
+
+    def expire(self, map_name=None):
+        """
+        Forget the probed epoch of map_name, or of all maps, e.g. after this
+        client changed a map, so the next read probes again.
+        """
+        with self._lock:
+            if map_name is None:
+                self._probes.clear()
+            else:
+                self._probes.pop(map_name, None)
+
+    def clear(self):
+        with self._lock:
+            self._probes.clear()
+            self._entries.clear()
+
+    def fetch(self, map_name, key, probe, fetch):
+        """
+        Return the output cached for key if its map is still at the same
+        epoch, otherwise call fetch() and cache its output. fetch() returns
+        (output, live); output that was not read live from the cluster,
+        e.g. served from the snapshot, is returned but not cached. The
+        output is shared by all callers and must not be modified.
+        """
+        epoch = self.current_epoch(map_name, probe)
+        if epoch is not None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == epoch:
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+
+        # The epoch was read before the live fetch, the output is at least
+        # that recent, so a later probe returning the same epoch proves it
+        # fresh.
+        output, live = fetch()
+        if live and output is not None and epoch is not None:
+            with self._lock:
+                self._entries[key] = (epoch, output)
+        return output
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        entries=len(self._entries))
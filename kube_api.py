@@ -24,10 +24,22 @@ import sys
 import yaml
 #import tenacity
 import string
+import concurrency as concurrency
+import tracing as tracing
+
+# Number of attempts for a read-modify-write when the apiserver rejects the
+# replace because the resourceVersion moved underneath us.
+CONFLICT_RETRIES = 3
 
 class ApiError(Exception):
     pass
 
+def is_conflict_error(error):
+    message = error.args[0] if error.args else b''
+    if isinstance(message, bytes):
+        message = message.decode(errors='replace')
+    return 'the object has been modified' in str(message)
+
 class KubeOperator(object):
 
     def __init__(self, namespace):
@@ -35,6 +47,7 @@ class KubeOperator(object):
         Initialize the class, get the necessary parameters
         """
         self._ns = namespace
+        self.locks = concurrency.ResourceLocks()
 
     def build_kuebctl_command(self, basic_command, resource=None, name=None,
                               flags=None, with_definition=False):
@@ -51,20 +64,38 @@ class KubeOperator(object):
         return command
 
     def execute_kubectl_command(self, command, definition, timeout=None):
-        execute_process = subprocess.Popen(command, stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        stdout, stderr = execute_process.communicate(yaml.dump(definition).encode())
-        execute_process.stdin.close()
-        if execute_process.wait(timeout) != 0:
-            raise ApiError(stderr)
+        payload = yaml.dump(definition).encode()
+        with tracing.span('kubectl.%s' % command[1],
+                          {'process.command_args': command,
+                           'process.stdin_bytes': len(payload)}) as span:
+            execute_process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            stdout, stderr = execute_process.communicate(payload)
+            execute_process.stdin.close()
+            returncode = execute_process.wait(timeout)
+            span.set_attribute('process.exit_code', returncode)
+            if returncode != 0:
+                raise ApiError(stderr)
 
     def execute_kubectl_command_with_output(self, command, timeout=None):
-        execute_process = subprocess.Popen(command, stdout=subprocess.PIPE,
-            stderr=sys.stderr)
-        objects = yaml.safe_load(execute_process.stdout)
-        if execute_process.wait(timeout) != 0:
-            raise ApiError
-        return objects
+        with tracing.span('kubectl.%s' % command[1],
+                          {'process.command_args': command}) as span:
+            execute_process = subprocess.Popen(command,
+                stdout=subprocess.PIPE, stderr=sys.stderr)
+            if not tracing.get_tracer().enabled:
+                objects = yaml.safe_load(execute_process.stdout)
+            else:
+                # Read the output first to time the process and the parsing
+                # apart.
+                stdout = execute_process.stdout.read()
+                span.set_attribute('process.stdout_bytes', len(stdout))
+                with tracing.span('parse', {'parse.bytes': len(stdout)}):
+                    objects = yaml.safe_load(stdout)
+            returncode = execute_process.wait(timeout)
+            span.set_attribute('process.exit_code', returncode)
+            if returncode != 0:
+                raise ApiError
+            return objects
 
     #@tenacity.retry(reraise=True, 
     #                retry=tenacity.retry_if_exception_type(ApiError),
@@ -92,6 +123,33 @@ class KubeOperator(object):
         return self.execute_kubectl_command_with_output(command, timeout)
 
 
+    def command_resource_version(self, resource, name, timeout=None):
+        command = self.build_kuebctl_command('get', resource=resource,
+            name=name, flags=['-o', 'jsonpath={.metadata.resourceVersion}'])
+        return self.execute_kubectl_command_with_output(command, timeout)
+
+    def command_list(self, resource, selector=None, timeout=None):
+        flags = ['-o', 'yaml']
+        if selector:
+            flags = ['-l', selector] + flags
+        command = self.build_kuebctl_command('get', resource=resource,
+            flags=flags)
+        return self.execute_kubectl_command_with_output(command, timeout)
+
+    def command_watch(self, resource, name=None, selector=None):
+        """
+        Start a watch on the resource and return the process, it writes one
+        line to stdout for every change. The process leads its own process
+        group; the caller owns it and must terminate the group.
+        """
+        flags = ['--watch-only', '-o', 'name']
+        if selector:
+            flags = ['-l', selector] + flags
+        command = self.build_kuebctl_command('get', resource=resource,
+            name=name, flags=flags)
+        return subprocess.Popen(command, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+
     def command_replace(self, definition, timeout=None):
         command = self.build_kuebctl_command('replace', flags=['--cascade'],
             with_definition=True)
@@ -143,22 +201,47 @@ class KubeOperator(object):
 
         return value
 
+    def update_resource_object(self, resource, name, mutate, timeout=None):
+        """
+        Read-modify-write of a resource. mutate(objects) edits the objects
+        read in place, or returns False to leave the resource unchanged. It
+        is called again on the object read by every retry, so the new value
+        is always computed from the version that is replaced.
+
+        The cycle holds the lock of (resource, name), and the replace carries
+        the resourceVersion that was read, so a concurrent writer outside
+        this process makes the apiserver reject it. The cycle is retried on
+        such conflicts. Return True when the resource was replaced.
+        """
+        with self.locks.hold(resource, name):
+            for attempt in range(CONFLICT_RETRIES):
+                objects = self.command_get(resource, name, timeout)
+                if not objects:
+                    print("Fail to get resource %s." %name)
+                    return False
+
+                if mutate(objects) is False:
+                    return False
+
+                try:
+                    self.command_replace(objects, timeout)
+                    return True
+                except ApiError as e:
+                    if (not is_conflict_error(e) or
+                            attempt == CONFLICT_RETRIES - 1):
+                        raise
+                    print("Conflict when replace resource %s, retry." %name)
+
     def override_resource_object(self, resource, name, key, value, timeout=None):
         """
         Implement the function to override pararmeters in ceph-cluster helm
-        chart.
+        chart. value does not depend on the current object, use
+        update_resource_object() when it does.
         """
-        objects = self.command_get(resource, name, timeout)
-        if not objects:
-            print("Fail to get resource %s." %name)
-            return
-        
-        if self.get_object_value(objects, key) is None:
-            print("Fail to get resource object %s." %key)
-            return
-        
-        new_objects = self.set_object_value(objects, key, value)
-        #print("New Object before replace ............\n")
-        #print(new_objects)
+        def mutate(objects):
+            if self.get_object_value(objects, key) is None:
+                print("Fail to get resource object %s." %key)
+                return False
+            self.set_object_value(objects, key, value)
 
-        self.command_replace(new_objects, timeout)
+        return self.update_resource_object(resource, name, mutate, timeout)
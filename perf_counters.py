@@ -0,0 +1,215 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Collect 'perf dump' from every osd and mon daemon in parallel.
+
+The per-daemon payloads are flattened into a daemon x counter NumPy matrix
+(PerfSnapshot). Two snapshots give a PerfDelta with counter deltas, rates and
+average latencies, which is what is needed to spot a slow daemon.
+Requests still go through the operator scheduler and its concurrency cap,
+but take their tokens from a bucket of their own (rate per second), so a
+collection does not drain the rate limit of the other callers.
+"""
+
+import time
+from concurrent import futures
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import scheduler as scheduler
+
+MAX_WORKERS = 16
+RATE = 100.0
+
+
+def flatten_perf_dump(output):
+    """
+    Flatten {section: {counter: value}} to {'section.counter': value}.
+    Averaged counters ({avgcount, sum, avgtime}) give one column per field,
+    histograms and other nested values are skipped.
+    """
+    counters = {}
+    for section, values in (output or {}).items():
+        if not isinstance(values, dict):
+            continue
+        for name, value in values.items():
+            key = '%s.%s' % (section, name)
+            if isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                counters[key] = value
+            elif isinstance(value, dict) and 'avgcount' in value:
+                for field in ('avgcount', 'sum', 'avgtime'):
+                    if isinstance(value.get(field), (int, float)):
+                        counters['%s.%s' % (key, field)] = value[field]
+    return counters
+
+
+class PerfSnapshot(object):
+
+    def __init__(self, timestamp, daemons, counters, values, errors=None):
+        self.timestamp = timestamp
+        self.daemons = daemons
+        self.counters = counters
+        self.values = values
+        self.errors = errors or {}
+        self._daemon_index = dict((d, i) for i, d in enumerate(daemons))
+        self._counter_index = dict((c, i) for i, c in enumerate(counters))
+
+    @classmethod
+    def from_dumps(cls, timestamp, dumps, errors=None):
+        daemons = sorted(dumps)
+        flat = [flatten_perf_dump(dumps[daemon]) for daemon in daemons]
+        counters = sorted(set().union(*flat)) if flat else []
+        index = dict((c, i) for i, c in enumerate(counters))
+        values = np.full((len(daemons), len(counters)), np.nan)
+        for row, counter_values in enumerate(flat):
+            for counter, value in counter_values.items():
+                values[row, index[counter]] = value
+        return cls(timestamp, daemons, counters, values, errors)
+
+    def column(self, counter):
+        return self.values[:, self._counter_index[counter]]
+
+    def row(self, daemon):
+        values = self.values[self._daemon_index[daemon]]
+        return dict((c, float(v)) for c, v in zip(self.counters, values)
+                    if not np.isnan(v))
+
+    def delta(self, previous):
+        return PerfDelta(previous, self)
+
+
+class PerfDelta(object):
+    """
+    Counter changes between two snapshots, aligned on the daemons and
+    counters present in both. Gauges may go down and give negative deltas.
+    A daemon whose averaged counters (avgcount, sum), which only grow, went
+    backwards has restarted: it is listed in restarted and its whole row is
+    nan.
+    """
+
+    def __init__(self, previous, current):
+        self.interval = current.timestamp - previous.timestamp
+        self.daemons = [d for d in current.daemons
+                        if d in previous._daemon_index]
+        self.counters = [c for c in current.counters
+                         if c in previous._counter_index]
+        cur = current.values[np.ix_(
+            [current._daemon_index[d] for d in self.daemons],
+            [current._counter_index[c] for c in self.counters])]
+        prev = previous.values[np.ix_(
+            [previous._daemon_index[d] for d in self.daemons],
+            [previous._counter_index[c] for c in self.counters])]
+        self.values = cur - prev
+        monotonic = [i for i, c in enumerate(self.counters)
+                     if c.endswith('.avgcount') or c.endswith('.sum')]
+        with np.errstate(invalid='ignore'):
+            restarted = (self.values[:, monotonic] < 0).any(axis=1)
+        self.values[restarted] = np.nan
+        self.restarted = [d for d, r in zip(self.daemons, restarted) if r]
+        self._counter_index = dict((c, i) for i, c in enumerate(self.counters))
+
+    def column(self, counter):
+        return self.values[:, self._counter_index[counter]]
+
+    def rate(self, counter):
+        if self.interval <= 0:
+            return np.full(len(self.daemons), np.nan)
+        return self.column(counter) / self.interval
+
+    def average(self, counter):
+        """
+        Average of an averaged counter over the interval, e.g. the latency
+        of 'osd.op_latency' as delta(sum) / delta(avgcount).
+        """
+        count = self.column('%s.avgcount' % counter)
+        total = self.column('%s.sum' % counter)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(count > 0, total / count, np.nan)
+
+    def outliers(self, values, threshold=3.5):
+        """
+        Daemons whose value is far above the others, by modified z-score
+        (median and median absolute deviation).
+        """
+        valid = ~np.isnan(values)
+        if valid.sum() < 3:
+            return []
+        median = np.median(values[valid])
+        mad = np.median(np.abs(values[valid] - median))
+        if mad == 0:
+            return []
+        scores = 0.6745 * (values - median) / mad
+        return [d for d, score in zip(self.daemons, scores)
+                if not np.isnan(score) and score > threshold]
+
+
+class PerfCollector(object):
+
+    def __init__(self, api, max_workers=MAX_WORKERS,
+                 priority=scheduler.Priority.audit, rate=RATE):
+        if np is None:
+            raise ImportError("numpy is required by the perf collector")
+        self.api = api
+        self.max_workers = max_workers
+        self.priority = priority
+        self.bucket = scheduler.TokenBucket(rate, max_workers) if rate \
+            else None
+
+    def daemons(self, daemon_types=('osd', 'mon')):
+        daemons = []
+        if 'osd' in daemon_types:
+            daemons += [node.name for node in self.api.osd_tree_nodes()
+                        if node.is_osd and node.status == 'up']
+        if 'mon' in daemon_types:
+            quorum = self.api.quorum_status() or {}
+            daemons += ['mon.%s' % name for name in
+                        quorum.get('quorum_names', [])]
+        return daemons
+
+    def _dump(self, daemon, timeout):
+        # The priority and budget are per thread, set them in the worker.
+        with self.api.priority(self.priority), self.api.budget(self.bucket):
+            return self.api.daemon_perf_dump(daemon, timeout=timeout)
+
+    def collect(self, daemons=None, daemon_types=('osd', 'mon'),
+                timeout=None):
+        if daemons is None:
+            daemons = self.daemons(daemon_types)
+        dumps = {}
+        errors = {}
+        workers = max(1, min(self.max_workers, len(daemons)))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = dict((executor.submit(self._dump, daemon, timeout), daemon)
+                        for daemon in daemons)
+            for job in futures.as_completed(jobs):
+                daemon = jobs[job]
+                try:
+                    output = job.result()
+                except Exception as e:
+                    errors[daemon] = str(e)
+                    continue
+                if output:
+                    dumps[daemon] = output
+                else:
+                    errors[daemon] = 'no output'
+        return PerfSnapshot.from_dumps(time.time(), dumps, errors)
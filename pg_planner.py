@@ -0,0 +1,164 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Placement group planning for every pool of every tier in one pass.
+
+This follows the sysinv pool audit: for each pool
+
+    target_pg_num = next power of 2 of
+        (Target PGs per OSD) * (# OSD) * (% Data) / Size
+
+where # OSD is rounded up as if the number of hosts of the tier were a
+multiple of the replication. pgp_num is first raised to pg_num, and pg_num
+is raised towards the target by at most 32 PGs per OSD per step.
+
+The topology comes from the crush tree (one 'osd tree'), the current values
+from one 'osd pool ls detail'; no per-pool query is needed.
+"""
+
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TARGET_PGS_PER_OSD = 200
+MAX_PG_STEP_PER_OSD = 32
+
+TierTopology = collections.namedtuple('TierTopology',
+    ['osds', 'hosts', 'last_host_osds'])
+
+PgChange = collections.namedtuple('PgChange',
+    ['pool', 'var', 'value', 'current'])
+
+
+def tier_topology(nodes):
+    """
+    Count the osds and hosts under every crush root. nodes are the records
+    of RookCephApi.osd_tree_nodes(). last_host_osds is the osd count of the
+    host with the highest name, as the sysinv audit uses it to round up.
+    """
+    search_tree = nodes.by_id()
+    topology = {}
+    for root in search_tree.values():
+        if root.type != 'root':
+            continue
+        osds = 0
+        hosts = {}
+        pending = list(root.children)
+        while pending:
+            node = search_tree.get(pending.pop())
+            if node is None:
+                continue
+            if node.is_osd:
+                osds += 1
+                continue
+            if node.type == 'host':
+                hosts[node.name] = sum(1 for child in node.children
+                    if child in search_tree and search_tree[child].is_osd)
+            pending.extend(node.children)
+        last_host_osds = hosts[max(hosts)] if hosts else 0
+        topology[root.name] = TierTopology(osds, len(hosts), last_host_osds)
+    return topology
+
+
+def next_power_of_2(values):
+    # Same as 1 << (int(value) - 1).bit_length() for each value.
+    values = np.floor(values).astype(np.int64)
+    result = np.full(values.shape, 2, dtype=np.int64)
+    positive = values > 0
+    result[positive] = np.left_shift(1, np.ceil(
+        np.log2(values[positive])).astype(np.int64))
+    return result
+
+
+class PgPlanner(object):
+
+    def __init__(self, target_pgs_per_osd=TARGET_PGS_PER_OSD,
+                 max_step_per_osd=MAX_PG_STEP_PER_OSD):
+        if np is None:
+            raise ImportError("numpy is required by the pg planner")
+        self.target_pgs_per_osd = target_pgs_per_osd
+        self.max_step_per_osd = max_step_per_osd
+
+    def targets(self, topology, pools, current=None):
+        """
+        Compute target pg_num for all pools at once.
+
+        topology: {tier root name: TierTopology}
+        pools: list of dicts with 'pool_name', 'tier' (crush root name),
+            'data_pt' (percent of the tier data) and optionally
+            'replication' (the pool size from current when omitted).
+        current: {pool name: dict(pg_num=, pgp_num=, size=)}
+        Returns {pool name: (target_pg_num, osds)}, pools of an unknown
+        tier or without osds are left out.
+        """
+        current = current or {}
+        pools = [p for p in pools if p['tier'] in topology]
+        if not pools:
+            return {}
+
+        tiers = [topology[p['tier']] for p in pools]
+        osds = np.array([t.osds for t in tiers], dtype=np.float64)
+        hosts = np.array([t.hosts for t in tiers], dtype=np.int64)
+        last_host_osds = np.array([t.last_host_osds for t in tiers],
+                                  dtype=np.float64)
+        data_pt = np.array([p['data_pt'] for p in pools], dtype=np.float64)
+        replication = np.array(
+            [p.get('replication') or
+             current.get(p['pool_name'], {}).get('size') or 1
+             for p in pools], dtype=np.int64)
+
+        gap = hosts % replication
+        adjust = np.where((gap != 0) & (last_host_osds != 0),
+                          (replication - gap) * last_host_osds, 0)
+        raw = (osds + adjust) * self.target_pgs_per_osd * data_pt / 100 / \
+            replication
+        target = next_power_of_2(raw)
+
+        valid = (osds > 0) & (data_pt > 0)
+        return dict((p['pool_name'], (int(t), int(o)))
+                    for p, t, o, v in zip(pools, target, osds, valid) if v)
+
+    def plan(self, topology, pools, current, healthy=True):
+        """
+        Return the PgChange list that brings the pools towards their target.
+        pg_num is only raised when the cluster is healthy.
+        """
+        targets = self.targets(topology, pools, current)
+        names = [name for name in targets if name in current]
+        if not names:
+            return []
+
+        pg_num = np.array([current[n]['pg_num'] for n in names])
+        pgp_num = np.array([current[n]['pgp_num'] for n in names])
+        target = np.array([targets[n][0] for n in names])
+        osds = np.array([targets[n][1] for n in names])
+
+        changes = []
+        for i in np.nonzero(pgp_num < pg_num)[0]:
+            changes.append(PgChange(names[i], 'pgp_num', int(pg_num[i]),
+                                    int(pgp_num[i])))
+
+        if healthy:
+            step = np.minimum(target, pg_num + osds * self.max_step_per_osd)
+            for i in np.nonzero(pg_num < target)[0]:
+                changes.append(PgChange(names[i], 'pg_num', int(step[i]),
+                                        int(pg_num[i])))
+        return changes
@@ -0,0 +1,225 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Priority scheduling and rate limiting of the commands sent to the cluster.
+
+Commands still run on the calling thread; the scheduler only decides when.
+Waiting callers are admitted by priority class, at most max_concurrency at a
+time, and every command except liveness checks needs a token from a token
+bucket to be admitted. A caller waiting for a token holds no slot, so a
+rate-limited burst cannot keep the callers of another bucket out. Liveness
+checks also get reserved slots above the cap so a burst of slow commands
+cannot hold them back.
+"""
+
+import contextlib
+import enum
+import heapq
+import itertools
+import threading
+import time
+
+import tracing as tracing
+
+# The bucket of a thread that did not pick one with budget().
+_SHARED = object()
+
+MAX_CONCURRENCY = 8
+RESERVED_LIVENESS = 1
+RATE = 10.0
+BURST = 20
+
+
+class Priority(enum.IntEnum):
+    liveness = 0
+    interactive = 1
+    audit = 2
+    bulk = 3
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # Take a token now, possibly going negative, and return how long the
+        # caller has to wait for it.
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def try_acquire(self):
+        """
+        Take a token if one is available and return 0, otherwise take
+        nothing and return how long until one is.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class _Stats(object):
+    __slots__ = ('queued', 'running', 'admitted', 'completed', 'wait_total',
+                 'wait_max')
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.admitted = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class CommandScheduler(object):
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, rate=RATE,
+                 burst=BURST, reserved_liveness=RESERVED_LIVENESS):
+        self.max_concurrency = max_concurrency
+        self.reserved_liveness = reserved_liveness
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self._cond = threading.Condition(threading.Lock())
+        self._waiting = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._stats = dict((p, _Stats()) for p in Priority)
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """
+        Run the commands issued by this thread inside the block with the
+        given priority, e.g. Priority.audit for a periodic audit.
+        """
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    @contextlib.contextmanager
+    def budget(self, bucket):
+        """
+        Take the tokens of the commands issued by this thread inside the
+        block from bucket instead of the shared bucket, e.g. to give a
+        fan-out its own rate limit. None lifts the rate limit.
+        """
+        previous = getattr(self._local, 'bucket', _SHARED)
+        self._local.bucket = bucket
+        try:
+            yield
+        finally:
+            self._local.bucket = previous
+
+    def current_priority(self, default=Priority.interactive):
+        priority = getattr(self._local, 'priority', None)
+        if priority is None:
+            return default
+        return priority
+
+    def _limit(self, priority):
+        if priority == Priority.liveness:
+            return self.max_concurrency + self.reserved_liveness
+        return self.max_concurrency
+
+    def run(self, priority, func, *args, **kwargs):
+        start = time.time()
+        stats = self._stats[priority]
+        entry = (priority, next(self._seq))
+        bucket = getattr(self._local, 'bucket', _SHARED)
+        if bucket is _SHARED:
+            bucket = self.bucket
+        if priority == Priority.liveness:
+            bucket = None
+
+        with self._cond:
+            stats.queued += 1
+            while True:
+                heapq.heappush(self._waiting, entry)
+                while (self._waiting[0] != entry or
+                       self._running >= self._limit(priority)):
+                    self._cond.wait()
+                heapq.heappop(self._waiting)
+                delay = bucket.try_acquire() if bucket is not None else 0
+                if delay <= 0:
+                    break
+                # Out of tokens: wait for one without holding a slot or the
+                # head of the queue, then queue again at the same place.
+                self._cond.notify_all()
+                deadline = time.time() + delay
+                while time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+            stats.queued -= 1
+            stats.running += 1
+            self._running += 1
+            stats.admitted += 1
+            waited = time.time() - start
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+            # The next waiter may be admitted as well.
+            self._cond.notify_all()
+
+        tracing.current_span().set_attribute('scheduler.wait', waited)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._cond:
+                stats.running -= 1
+                stats.completed += 1
+                self._running -= 1
+                self._cond.notify_all()
+
+    def metrics(self):
+        """
+        Queue depth, running count and wait times (seconds) per priority.
+        """
+        with self._cond:
+            metrics = {}
+            for priority, stats in self._stats.items():
+                metrics[priority.name] = dict(
+                    queued=stats.queued,
+                    running=stats.running,
+                    completed=stats.completed,
+                    wait_avg=(stats.wait_total / stats.admitted
+                              if stats.admitted else 0.0),
+                    wait_max=stats.wait_max)
+            return metrics
@@ -0,0 +1,342 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+On-disk snapshot of the cluster state read through the client.
+
+The snapshot lets a restarted client answer its first reads from disk while
+it revalidates them in the background. Every entry is tagged: ceph map reads
+with the osdmap epoch, kubernetes objects with their resourceVersion, and
+the file with the cluster fsid. Pod and resource names are not kept, they
+are looked up live.
+
+File layout (little endian), loaded with mmap so only the index is parsed
+up front and each payload is decoded on first use:
+
+    header  8s magic, H version, I entry count, Q data offset,
+            H fsid length, fsid
+    index   per entry: d stored_at, Q payload offset, I payload length,
+            H key length, key, H tag length, tag
+    data    zlib compressed JSON payloads
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'RKSNAP\x00\x01'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHIQ')
+ENTRY = struct.Struct('<dQI')
+LENGTH = struct.Struct('<H')
+
+# Key kinds, the first element of every key.
+CEPH = 'ceph'
+KUBE = 'kube'
+
+MISS = object()
+
+# Revalidation retries while the cluster cannot be reached, in seconds.
+RETRY_INTERVAL = 1
+MAX_RETRY_INTERVAL = 30
+WARMUP_TIMEOUT = 600
+
+
+def make_key(kind, *args):
+    return json.dumps([kind] + list(args), separators=(',', ':'))
+
+
+def parse_key(key):
+    return json.loads(key)
+
+
+class _Entry(object):
+    __slots__ = ('tag', 'stored_at', 'value', 'offset', 'length', 'stale')
+
+    def __init__(self, tag, stored_at, value=MISS, offset=0, length=0):
+        self.tag = tag
+        self.stored_at = stored_at
+        self.value = value
+        self.offset = offset
+        self.length = length
+        self.stale = False
+
+
+class SnapshotStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.fsid = None
+        self.serving = False
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._file = None
+        self._mmap = None
+
+    def load(self):
+        """
+        Map the snapshot file and parse its index. A missing or corrupt file
+        gives an empty store. Loaded entries are served until
+        finish_warmup() is called.
+        """
+        try:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+            self._parse()
+        except (OSError, ValueError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("Fail to load snapshot %s: %s." % (self.path, e))
+            self._close()
+            self._entries = {}
+            self.fsid = None
+        self.serving = bool(self._entries)
+        return len(self._entries)
+
+    def _read_string(self, pos):
+        (length,) = LENGTH.unpack_from(self._mmap, pos)
+        pos += LENGTH.size
+        return self._mmap[pos:pos + length].decode('utf-8'), pos + length
+
+    def _parse(self):
+        magic, version, count, data_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("unknown snapshot format")
+        fsid, pos = self._read_string(HEADER.size)
+        entries = {}
+        for i in range(count):
+            stored_at, offset, length = ENTRY.unpack_from(self._mmap, pos)
+            key, pos = self._read_string(pos + ENTRY.size)
+            tag, pos = self._read_string(pos)
+            if data_offset + offset + length > len(self._mmap):
+                raise ValueError("truncated snapshot")
+            entries[key] = _Entry(tag or None, stored_at,
+                offset=data_offset + offset, length=length)
+        self.fsid = fsid or None
+        self._entries = entries
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _value(self, entry):
+        if entry.value is MISS:
+            payload = self._mmap[entry.offset:entry.offset + entry.length]
+            entry.value = json.loads(zlib.decompress(payload).decode('utf-8'))
+        return entry.value
+
+    def get(self, key):
+        """
+        Return the snapshot value of key while warming up, MISS otherwise.
+        """
+        with self._lock:
+            if not self.serving:
+                return MISS
+            entry = self._entries.get(key)
+            if entry is None or entry.stale:
+                return MISS
+            try:
+                return self._value(entry)
+            except (ValueError, zlib.error):
+                entry.stale = True
+                return MISS
+
+    def tag(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.tag if entry is not None else None
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def put(self, key, value, tag):
+        with self._lock:
+            self._entries[key] = _Entry(
+                str(tag) if tag is not None else None, time.time(), value)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            entries = [self._entries.get(key)] if key else \
+                self._entries.values()
+            for entry in entries:
+                if entry is not None:
+                    entry.stale = True
+
+    def finish_warmup(self):
+        self.serving = False
+
+    def save(self, fsid=None):
+        """
+        Write all fresh entries to a new file and atomically replace the
+        snapshot with it.
+        """
+        with self._lock:
+            if fsid is not None:
+                self.fsid = fsid
+            items = []
+            for key, entry in self._entries.items():
+                if entry.stale:
+                    continue
+                if entry.value is MISS:
+                    # Never decoded, copy the payload as it is.
+                    payload = self._mmap[entry.offset:
+                                         entry.offset + entry.length]
+                else:
+                    payload = zlib.compress(json.dumps(entry.value,
+                        default=str, separators=(',', ':')).encode('utf-8'))
+                items.append((key, entry, payload))
+
+        def string(value):
+            data = (value or '').encode('utf-8')
+            return LENGTH.pack(len(data)) + data
+
+        index = []
+        data = []
+        offset = 0
+        for key, entry, payload in items:
+            index.append(ENTRY.pack(entry.stored_at, offset, len(payload)) +
+                         string(key) + string(entry.tag))
+            data.append(payload)
+            offset += len(payload)
+        fsid = string(self.fsid)
+        data_offset = HEADER.size + len(fsid) + sum(len(i) for i in index)
+
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(items), data_offset))
+            f.write(fsid)
+            f.writelines(index)
+            f.writelines(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return len(items)
+
+
+class SnapshotRevalidator(object):
+    """
+    Check every loaded entry against the live cluster on a background thread
+    and refresh the stale ones, then end the warm-up and save the snapshot.
+
+    While the cluster cannot be reached (e.g. the toolbox pod is not up yet
+    after a reboot) the snapshot keeps being served and the revalidation is
+    retried with a backoff. Entries are only dropped for a different fsid or
+    a stale tag. If the cluster is still unreachable after warmup_timeout
+    seconds the warm-up ends and the file is left as it is.
+
+    operator provides: live_fsid(), live_osdmap_epoch(), refresh(key) which
+    fetches the live value of a key and returns (value, tag), and
+    current_tag(key) for kubernetes keys (the resourceVersion).
+    """
+
+    def __init__(self, store, operator, retry_interval=RETRY_INTERVAL,
+                 max_retry_interval=MAX_RETRY_INTERVAL,
+                 warmup_timeout=WARMUP_TIMEOUT):
+        self.store = store
+        self.operator = operator
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.warmup_timeout = warmup_timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run,
+            name='rookclient-snapshot-revalidate')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        deadline = time.monotonic() + self.warmup_timeout
+        interval = self.retry_interval
+        while True:
+            try:
+                self.revalidate()
+                break
+            except Exception as e:
+                if self._stop.is_set() or time.monotonic() >= deadline:
+                    # Keep the file, it is still the best start for the
+                    # next restart.
+                    print("Fail to revalidate snapshot, stop serving it: "
+                          "%s." % e)
+                    self.store.finish_warmup()
+                    return
+                print("Cluster not reachable to revalidate snapshot, retry "
+                      "in %ss: %s." % (interval, e))
+                self._stop.wait(interval)
+                interval = min(interval * 2, self.max_retry_interval)
+
+        self.store.finish_warmup()
+        try:
+            self.store.save()
+        except Exception as e:
+            print("Fail to save snapshot %s: %s." % (self.store.path, e))
+
+    def revalidate(self):
+        # Nothing is dropped before the cluster answered both.
+        fsid = self.operator.live_fsid()
+        if not fsid:
+            raise ValueError("cluster fsid is unknown")
+        epoch = self.operator.live_osdmap_epoch()
+        if epoch is None:
+            raise ValueError("osdmap epoch is unknown")
+        if self.store.fsid and fsid != self.store.fsid:
+            # A different cluster, nothing in the snapshot applies.
+            self.store.invalidate()
+        self.store.fsid = fsid
+
+        for key in self.store.keys():
+            kind = parse_key(key)[0]
+            tag = self.store.tag(key)
+            if kind == CEPH:
+                valid = tag is not None and tag == str(epoch)
+            elif kind == KUBE:
+                current = self.operator.current_tag(key)
+                valid = tag is not None and str(current) == tag
+            else:
+                # Name lookups kept by older clients, drop them.
+                self.store.invalidate(key)
+                continue
+            if valid:
+                continue
+            # The tag is stale, the entry goes unless it can be refreshed.
+            try:
+                value, new_tag = self.operator.refresh(key)
+            except Exception as e:
+                print("Fail to refresh snapshot entry %s: %s." % (key, e))
+                value = None
+            if value is None:
+                self.store.invalidate(key)
+            else:
+                self.store.put(key, value, new_tag)
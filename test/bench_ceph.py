@@ -0,0 +1,115 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+import gc
+import json
+import sys
+import tracemalloc
+sys.path.append('../')
+import ceph_model as ceph_model
+
+
+def osd_df_payload(count):
+    nodes = []
+    for i in range(count):
+        nodes.append({
+            'id': i, 'device_class': 'hdd', 'name': 'osd.%d' % i,
+            'type': 'osd', 'type_id': 0, 'crush_weight': 0.0195,
+            'depth': 3, 'pool_weights': {}, 'reweight': 1.0,
+            'kb': 20961280, 'kb_used': 1066520, 'kb_used_data': 42520,
+            'kb_used_omap': 0, 'kb_used_meta': 1024000,
+            'kb_avail': 19894760, 'utilization': 5.088, 'var': 1.0,
+            'pgs': 96, 'status': 'up'})
+    return json.dumps({'nodes': nodes})
+
+
+def ceph_df_payload(count):
+    pools = []
+    for i in range(count):
+        pools.append({
+            'name': 'pool-%d' % i, 'id': i,
+            'stats': {'kb_used': 1024, 'bytes_used': 1048576,
+                      'percent_used': 0.01, 'max_avail': 6039797760,
+                      'objects': 12, 'stored': 349525}})
+    return json.dumps({'pools': pools})
+
+
+def pg_stuck_payload(count):
+    pgs = []
+    for i in range(count):
+        pgs.append({
+            'pgid': '1.%x' % i, 'state': 'active+undersized',
+            'last_clean': '2019-10-10 10:10:10.000000',
+            'last_active': '2019-10-10 10:10:10.000000',
+            'last_peered': '2019-10-10 10:10:10.000000',
+            'last_undegraded': '2019-10-10 10:10:10.000000',
+            'last_fullsized': '2019-10-10 10:10:10.000000',
+            'up': [i % 7, (i + 1) % 7], 'acting': [i % 7, (i + 1) % 7],
+            'up_primary': i % 7, 'acting_primary': i % 7})
+    return json.dumps(pgs)
+
+
+def crush_dump_payload(count):
+    buckets = []
+    for i in range(count):
+        buckets.append({
+            'id': -(i + 1), 'name': 'host-%d' % i, 'type_id': 1,
+            'type_name': 'host', 'weight': 2 * 1281, 'alg': 'straw2',
+            'hash': 'rjenkins1',
+            'items': [{'id': 2 * i, 'weight': 1281, 'pos': 0},
+                      {'id': 2 * i + 1, 'weight': 1281, 'pos': 1}]})
+    return json.dumps({'buckets': buckets})
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    objects = build()
+    gc.collect()
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in end.compare_to(start, 'filename'))
+    return objects, size
+
+
+def bench_record_memory(count=10000):
+    cases = [
+        ('osd df node', ceph_model.OsdNode, osd_df_payload,
+            lambda output: output['nodes']),
+        ('ceph df pool', ceph_model.PoolStats, ceph_df_payload,
+            lambda output: output['pools']),
+        ('pg stuck stat', ceph_model.PgStat, pg_stuck_payload,
+            lambda output: output),
+        ('crush bucket', ceph_model.CrushBucket, crush_dump_payload,
+            lambda output: output['buckets']),
+    ]
+    print("%-16s %12s %12s %8s" % ('record', 'dict B/rec', 'slots B/rec',
+                                   'ratio'))
+    for name, record_cls, payload, extract in cases:
+        text = payload(count)
+        raw, raw_size = measure(lambda: extract(json.loads(text)))
+        del raw
+        records, rec_size = measure(lambda: list(ceph_model.RecordList(
+            record_cls, extract(json.loads(text)))))
+        del records
+        print("%-16s %12.1f %12.1f %8.2f" % (name, raw_size / count,
+              rec_size / count, float(raw_size) / rec_size))
+
+
+if __name__ == "__main__":
+    bench_record_memory()
@@ -30,6 +30,11 @@ class CephApiTester(object):
         self.ceph_op = ceph.RookCephOperator('rook-ceph')
         self.api = ceph_api.RookCephApi('rook-ceph')
 
+    def test_transport_probe(self):
+        latency = self.ceph_op.transports.probe()
+        print("Transport latency: %s" % latency)
+        print("Current transport: %s" % self.ceph_op.transports.current())
+
     def test_command_get(self):
         #objects = self.op.command_get('CephCluster', 'rook-ceph', 'rook-ceph')
         objects = self.kube_op.command_get('configmap', 'rook-config-override')
@@ -62,6 +67,12 @@ class CephApiTester(object):
     def test_mon_remove(self):
         self.api.mon_remove('e')
 
+    def test_wait_api(self):
+        count = self.ceph_op.get_rook_mon_count()
+        print("Mon count converged: %s" %
+            self.api.wait_for_mon_count(count, timeout=60))
+        print("Health OK: %s" % self.api.wait_for_health_ok(timeout=60))
+
     def test_ceph_api(self):
         status = self.api.ceph_status()
         print(status)
@@ -76,6 +87,33 @@ class CephApiTester(object):
         output = self.api.osd_pool_create('aa', 128, 128)
         print(output)
 
+    def test_record_api(self):
+        nodes = self.api.osd_tree_nodes()
+        print(nodes.by_id())
+        pools = self.api.ceph_df_pools()
+        print([pool.name for pool in pools])
+        buckets = self.api.osd_crush_buckets()
+        print([bucket.name for bucket in buckets])
+        tiers = self.api.get_tiers_size()
+        print(tiers)
+
+    def test_capacity_sampler(self):
+        sampler = self.api.start_capacity_sampler(interval=5)
+        time.sleep(30)
+        print(sampler.latest('cluster'))
+        for pool in sampler.keys('pool'):
+            print(pool, sampler.rate('pool', pool, 'stored'),
+                sampler.time_to_full('pool', pool))
+        self.api.stop_capacity_sampler()
+
+    def test_tracing(self):
+        self.api.enable_tracing(slow_threshold=0.5)
+        self.api.ceph_health()
+        self.api.osd_tree()
+        self.api.get_tiers_size()
+        self.api.dump_slow_calls(clear=True)
+        self.api.disable_tracing()
+
     def test_crushmap_api(self):
         crushmap_txt_file = "crushmap.txt"
         crushmap_bin_file = "crushmap.bin"
@@ -100,6 +138,7 @@ class CephApiTester(object):
 if __name__ == "__main__":
     tester = CephApiTester()
     tester.test_command_get()
+    #tester.test_transport_probe()
     #tester.test_modify_rook_mon_count(3)
     #tester.test_get_rook_mon_count()
     
@@ -112,5 +151,9 @@ if __name__ == "__main__":
     #tester.test_command_execute_cli()
 
     tester.test_ceph_api()
+    #tester.test_record_api()
+    #tester.test_capacity_sampler()
     tester.test_crushmap_api()
     #tester.test_mon_remove()
+    #tester.test_wait_api()
+    #tester.test_tracing()
@@ -0,0 +1,941 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Checks of the client logic that need no cluster, run with pytest.
+"""
+
+import copy
+import json
+import os
+import random
+import subprocess
+import threading
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import capacity as capacity
+import ceph as ceph
+import ceph_api as ceph_api
+import ceph_model as ceph_model
+import concurrency as concurrency
+import convergence as convergence
+import epoch_cache as epoch_cache
+import kube_api as kube_api
+import perf_counters as perf_counters
+import pg_planner as pg_planner
+import scheduler as scheduler
+import snapshot as snapshot
+import tracing as tracing
+import transport as transport
+
+
+class StubTransport(transport.Transport):
+    """
+    Answer ceph commands from a dict keyed by the command words, without
+    'ceph' and the --format flag.
+    """
+    name = 'stub'
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.calls = []
+
+    def execute(self, cli, timeout=None):
+        words = [w for w in cli[1:] if w not in ('--format', 'json-pretty')]
+        self.calls.append(tuple(words))
+        output = self.outputs.get(tuple(words))
+        if isinstance(output, Exception):
+            raise output
+        return output() if callable(output) else output
+
+
+CEPH_DF = {'stats': {'total_bytes': 300, 'total_used_bytes': 30,
+                     'total_avail_bytes': 270},
+           'pools': [{'name': 'rbd', 'stats': {'stored': 10, 'bytes_used': 20,
+                                               'objects': 1,
+                                               'max_avail': 100}}]}
+OSD_DF = {'nodes': [{'id': 0, 'type': 'osd', 'kb': 1, 'kb_used': 0,
+                     'kb_avail': 1, 'pgs': 8}]}
+
+
+def sysinv_target_pg_num(topology, data_pt, replication,
+                         target_pgs_per_osd=pg_planner.TARGET_PGS_PER_OSD):
+    # The scalar sysinv audit formula the planner vectorizes.
+    osds = topology.osds
+    gap = topology.hosts % replication
+    if gap and topology.last_host_osds:
+        osds += (replication - gap) * topology.last_host_osds
+    raw = osds * target_pgs_per_osd * data_pt / 100 / replication
+    return 1 << (int(raw) - 1).bit_length()
+
+
+def test_pg_planner_matches_sysinv():
+    rand = random.Random(2019)
+    planner = pg_planner.PgPlanner()
+    for i in range(2000):
+        topology = dict(('tier-%d' % t, pg_planner.TierTopology(
+            rand.randint(1, 200), rand.randint(1, 20), rand.randint(0, 12)))
+            for t in range(3))
+        pools = [dict(pool_name='pool-%d' % p,
+                      tier='tier-%d' % rand.randint(0, 2),
+                      data_pt=rand.choice([1, 5, 10, 20, 25, 50, 100]),
+                      replication=rand.randint(1, 3))
+                 for p in range(rand.randint(1, 8))]
+        targets = planner.targets(topology, pools)
+        for pool in pools:
+            expected = sysinv_target_pg_num(topology[pool['tier']],
+                pool['data_pt'], pool['replication'])
+            assert targets[pool['pool_name']][0] == expected, (pool, topology)
+
+
+def test_pg_planner_steps():
+    planner = pg_planner.PgPlanner()
+    topology = {'storage-tier': pg_planner.TierTopology(4, 2, 2)}
+    pools = [dict(pool_name='rbd', tier='storage-tier', data_pt=100)]
+    current = {'rbd': dict(pg_num=64, pgp_num=32, size=2)}
+    changes = planner.plan(topology, pools, current)
+    assert pg_planner.PgChange('rbd', 'pgp_num', 64, 32) in changes
+    # target 512, raised by at most 32 PGs per OSD.
+    assert pg_planner.PgChange('rbd', 'pg_num', 192, 64) in changes
+    changes = planner.plan(topology, pools, current, healthy=False)
+    assert [c.var for c in changes] == ['pgp_num']
+
+
+def test_capacity_sampler_start():
+    stub = StubTransport({('fsid',): {'fsid': 'x'}, ('df',): CEPH_DF,
+                          ('osd', 'df', 'tree'): OSD_DF})
+    api = ceph_api.RookCephApi('rook-ceph', transports=[stub])
+    sampler = api.start_capacity_sampler(interval=3600, size=4)
+    try:
+        sampler.sample()
+    finally:
+        api.stop_capacity_sampler()
+    assert sampler.capacity == 4
+    assert sampler.latest('pool', 'rbd')['stored'] == 10
+    assert sampler.keys('osd') == [0]
+
+
+def test_epoch_cache_hit_and_miss():
+    cache = epoch_cache.EpochCache(probe_ttl=0)
+    epochs = [5]
+    fetches = []
+
+    def fetch():
+        fetches.append(epochs[0])
+        return {'epoch': epochs[0]}, True
+
+    probe = lambda map_name: epochs[0]
+    assert cache.fetch(epoch_cache.OSDMAP, 'tree', probe, fetch)['epoch'] == 5
+    assert cache.fetch(epoch_cache.OSDMAP, 'tree', probe, fetch)['epoch'] == 5
+    epochs[0] = 6
+    assert cache.fetch(epoch_cache.OSDMAP, 'tree', probe, fetch)['epoch'] == 6
+    assert fetches == [5, 6]
+    assert cache.stats() == dict(hits=1, misses=2, entries=1)
+
+
+def test_epoch_cache_skips_output_not_read_live():
+    cache = epoch_cache.EpochCache(probe_ttl=0)
+    probe = lambda map_name: 10
+    output = cache.fetch(epoch_cache.OSDMAP, 'tree', probe,
+                         lambda: ('old', False))
+    assert output == 'old'
+    assert cache.fetch(epoch_cache.OSDMAP, 'tree', probe,
+                       lambda: ('new', True)) == 'new'
+
+
+def test_snapshot_output_not_kept_after_warmup(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    key = snapshot.make_key(snapshot.CEPH, ['osd', 'tree'], 'json')
+    store = snapshot.SnapshotStore(path)
+    store.put(key, {'nodes': 'OLD'}, 5)
+    store.save('fsid-1')
+
+    stub = StubTransport({('fsid',): {'fsid': 'fsid-1'},
+                          ('osd', 'stat'): {'epoch': 10},
+                          ('osd', 'tree'): {'nodes': 'NEW'}})
+    op = ceph.RookCephOperator('rook-ceph', transports=[stub])
+    op.snapshot = snapshot.SnapshotStore(path)
+    op.snapshot.load()
+    op.epoch_cache.probe_ttl = 0
+    assert op.execute_toolbox_cli(['osd', 'tree'])['nodes'] == 'OLD'
+    op.snapshot.finish_warmup()
+    assert op.execute_toolbox_cli(['osd', 'tree'])['nodes'] == 'NEW'
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    store = snapshot.SnapshotStore(path)
+    assert store.load() == 0
+    kube_key = snapshot.make_key(snapshot.KUBE, 'configmap', 'mon')
+    ceph_key = snapshot.make_key(snapshot.CEPH, ['osd', 'tree'], 'json')
+    store.put(kube_key, {'data': {'data': 'a=1.2.3.4:6789'}}, '17')
+    store.put(ceph_key, {'nodes': [1, 2]}, 5)
+    assert store.save('fsid-1') == 2
+
+    store = snapshot.SnapshotStore(path)
+    assert store.load() == 2
+    assert store.fsid == 'fsid-1'
+    assert store.tag(ceph_key) == '5'
+    assert store.get(kube_key) == {'data': {'data': 'a=1.2.3.4:6789'}}
+    store.invalidate(kube_key)
+    assert store.get(kube_key) is snapshot.MISS
+    # Undecoded payloads are copied as they are.
+    assert store.save() == 1
+    store = snapshot.SnapshotStore(path)
+    assert store.load() == 1
+    assert store.get(ceph_key) == {'nodes': [1, 2]}
+    store.finish_warmup()
+    assert store.get(ceph_key) is snapshot.MISS
+
+
+def test_snapshot_corrupt_file(tmp_path):
+    path = tmp_path / 'snapshot'
+    path.write_bytes(snapshot.MAGIC + b'\x01')
+    store = snapshot.SnapshotStore(str(path))
+    assert store.load() == 0
+    assert not store.serving
+
+
+def saved_tree_snapshot(path):
+    store = snapshot.SnapshotStore(path)
+    store.put(snapshot.make_key(snapshot.CEPH, ['osd', 'tree'], 'json'),
+              {'nodes': []}, 5)
+    store.save('fsid-1')
+    store = snapshot.SnapshotStore(path)
+    assert store.load() == 1
+    return store
+
+
+def test_snapshot_revalidation_retries_while_unreachable(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    store = saved_tree_snapshot(path)
+    answers = [transport.TransportError("toolbox pod not found"),
+               transport.TransportError("toolbox pod not found")]
+    serving = []
+
+    def fsid():
+        serving.append(store.serving)
+        if answers:
+            raise answers.pop(0)
+        return {'fsid': 'fsid-1'}
+
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({
+        ('fsid',): fsid, ('osd', 'stat'): {'epoch': 5}})])
+    revalidator = snapshot.SnapshotRevalidator(store, op,
+        retry_interval=0.01, max_retry_interval=0.02)
+    revalidator.run()
+    # Served while the cluster was unreachable, saved once it answered.
+    assert serving == [True, True, True]
+    assert not store.serving
+    assert snapshot.SnapshotStore(path).load() == 1
+
+
+def test_snapshot_kept_when_cluster_never_answers(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    store = saved_tree_snapshot(path)
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({
+        ('fsid',): transport.TransportError("toolbox pod not found")})])
+    snapshot.SnapshotRevalidator(store, op, retry_interval=0.01,
+                                 warmup_timeout=0.05).run()
+    assert not store.serving
+    assert snapshot.SnapshotStore(path).load() == 1
+
+
+def test_snapshot_dropped_for_another_cluster(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    store = saved_tree_snapshot(path)
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({
+        ('fsid',): {'fsid': 'fsid-2'}, ('osd', 'stat'): {'epoch': 5},
+        ('osd', 'tree'): {'nodes': ['new']}})])
+    snapshot.SnapshotRevalidator(store, op).run()
+    store = snapshot.SnapshotStore(path)
+    assert store.load() == 0
+    assert store.fsid == 'fsid-2'
+
+
+def test_toolbox_pod_is_looked_up_live(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    store = snapshot.SnapshotStore(path)
+    store.put(snapshot.make_key('pod', ceph.POD_TOOLBOX), 'old-pod',
+              'old-pod')
+    store.save('fsid-1')
+
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({})])
+    op.snapshot = snapshot.SnapshotStore(path)
+    op.snapshot.load()
+    op.kube_op.command_find_pod = lambda app: 'new-pod'
+    assert op.find_toolbox_pod() == 'new-pod'
+
+    stub = StubTransport({('fsid',): {'fsid': 'fsid-1'},
+                          ('osd', 'stat'): {'epoch': 5}})
+    op.transports = transport.TransportSelector([stub])
+    snapshot.SnapshotRevalidator(op.snapshot, op).run()
+    assert snapshot.SnapshotStore(path).load() == 0
+
+
+class SwitchTransport(transport.Transport):
+
+    def __init__(self, name, up, available=True, delay=0):
+        self.name = name
+        self.up = up
+        self.is_available = available
+        self.delay = delay
+        self.calls = 0
+
+    def available(self):
+        return self.is_available
+
+    def execute(self, cli, timeout=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if not self.up:
+            raise transport.TransportError("%s down" % self.name)
+        return {'transport': self.name}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_transport_failover_to_transport_down_at_start():
+    local = SwitchTransport('local', True)
+    toolbox = SwitchTransport('toolbox', False)
+    selector = transport.TransportSelector([local, toolbox])
+    assert selector.current() == 'local'
+    local.up = False
+    toolbox.up = True
+    # Tried as a last resort once every probed transport failed.
+    assert selector.execute(['ceph', 'status']) == {'transport': 'toolbox'}
+    assert selector.current() == 'toolbox'
+
+
+def test_transport_failed_probe_reprobed_in_background():
+    local = SwitchTransport('local', True)
+    toolbox = SwitchTransport('toolbox', False, delay=0.3)
+    selector = transport.TransportSelector([local, toolbox],
+                                           reprobe_interval=0.05)
+    assert selector.current() == 'local'
+    toolbox.up = True
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert selector.execute(['ceph', 'status']) == {'transport': 'local'}
+    # The probe of the toolbox does not hold up the request.
+    assert time.monotonic() - start < 0.2
+    assert wait_until(lambda: 'toolbox' in selector._latency)
+    assert not selector._failed
+
+
+def test_transport_unavailable_never_reprobed():
+    local = SwitchTransport('local', True)
+    rados = SwitchTransport('rados', True, available=False)
+    selector = transport.TransportSelector([rados, local],
+                                           reprobe_interval=0)
+    for i in range(5):
+        assert selector.execute(['ceph', 'status']) == {'transport': 'local'}
+    assert rados.calls == 0
+    # One probe and the five commands, no probe since.
+    assert local.calls == 6
+    assert not selector._reprobing
+
+
+class ConflictingKube(object):
+    """
+    Serve one object, and let another writer change it between the first
+    read and replace, as the rook operator may.
+    """
+
+    def __init__(self, objects, concurrent):
+        self.objects = objects
+        self.concurrent = concurrent
+        self.replaced = []
+
+    def command_get(self, resource, name, timeout=None):
+        return copy.deepcopy(self.objects)
+
+    def command_replace(self, definition, timeout=None):
+        if self.concurrent is not None:
+            self.concurrent(self.objects)
+            self.concurrent = None
+            raise kube_api.ApiError(b'Operation cannot be fulfilled: '
+                                    b'the object has been modified')
+        self.objects = definition
+        self.replaced.append(definition)
+
+
+def conflicting_operator(objects, concurrent):
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({})])
+    kube = ConflictingKube(objects, concurrent)
+    op.kube_op.command_get = kube.command_get
+    op.kube_op.command_replace = kube.command_replace
+    op.kube_op.command_find_resource = lambda resource: 'rook-ceph'
+    return op, kube
+
+
+def test_step_mon_count_recomputed_on_conflict():
+    def concurrent(objects):
+        objects['spec']['mon']['count'] = 2
+
+    op, kube = conflicting_operator({'spec': {'mon': {'count': 1}}},
+                                    concurrent)
+    assert op.step_rook_mon_count(1)
+    assert kube.objects['spec']['mon']['count'] == 3
+    assert len(kube.replaced) == 1
+
+
+def test_remove_mon_keeps_concurrent_endpoint_change():
+    mapping = {'node': {'a': {}, 'b': {}, 'c': {}}}
+    configmap = {'data': {'data': 'a=10.0.0.1:6789,b=10.0.0.2:6789,'
+                                  'c=10.0.0.3:6789',
+                          'mapping': json.dumps(mapping)}}
+
+    def concurrent(objects):
+        objects['data']['data'] = objects['data']['data'].replace(
+            '10.0.0.3', '10.0.0.4')
+
+    op, kube = conflicting_operator(configmap, concurrent)
+    op.step_rook_mon_count = lambda step, timeout=None: True
+    assert op.remove_dedicated_ceph_mon('a') is True
+    assert kube.objects['data']['data'] == 'b=10.0.0.2:6789,c=10.0.0.4:6789'
+    assert sorted(json.loads(kube.objects['data']['mapping'])['node']) == \
+        ['b', 'c']
+
+
+def perf_dump(numpg, ops, latency_sum):
+    return {'osd': {'numpg': numpg,
+                    'op_latency': {'avgcount': ops, 'sum': latency_sum,
+                                   'avgtime': latency_sum / ops}}}
+
+
+def test_perf_delta_gauges_and_restarts():
+    previous = perf_counters.PerfSnapshot.from_dumps(0, {
+        'osd.0': perf_dump(100, 10, 1.0), 'osd.1': perf_dump(100, 10, 1.0)})
+    current = perf_counters.PerfSnapshot.from_dumps(10, {
+        'osd.0': perf_dump(80, 30, 3.0), 'osd.1': perf_dump(100, 2, 0.1)})
+    delta = current.delta(previous)
+    assert delta.restarted == ['osd.1']
+    assert delta.column('osd.numpg')[0] == -20
+    assert delta.rate('osd.op_latency.avgcount')[0] == 2.0
+    assert delta.average('osd.op_latency')[0] == 0.1
+    assert all(perf_counters.np.isnan(delta.values[1]))
+
+
+def test_perf_collect_has_its_own_budget():
+    osds = 60
+    outputs = {('fsid',): {'fsid': 'x'},
+               ('osd', 'tree'): {'nodes': [
+                   {'id': i, 'name': 'osd.%d' % i, 'type': 'osd',
+                    'status': 'up'} for i in range(osds)]},
+               ('quorum_status',): {'quorum_names': []}}
+    for i in range(osds):
+        outputs[('tell', 'osd.%d' % i, 'perf', 'dump')] = \
+            perf_dump(100, 10, 1.0)
+    api = ceph_api.RookCephApi('rook-ceph', transports=[StubTransport(outputs)])
+    start = time.time()
+    snap = api.collect_perf_counters()
+    # The shared bucket (10/s, burst 20) would take about 4s.
+    assert time.time() - start < 2
+    assert len(snap.daemons) == osds and not snap.errors
+
+
+def test_capacity_sampler_runs_at_audit_priority():
+    seen = []
+
+    class Api(object):
+        def __init__(self):
+            self.sched = scheduler.CommandScheduler()
+
+        def priority(self, priority):
+            return self.sched.priority(priority)
+
+        def ceph_df(self):
+            seen.append(self.sched.current_priority())
+            return CEPH_DF
+
+        def osd_df(self):
+            return OSD_DF
+
+    sampler = capacity.CapacitySampler(Api(), interval=3600)
+    sampler.start()
+    deadline = time.time() + 5
+    while not seen and time.time() < deadline:
+        time.sleep(0.01)
+    sampler.stop()
+    assert seen == [scheduler.Priority.audit]
+
+
+class WatchKube(object):
+    """
+    A watch that reports one change and leaves a grandchild holding its
+    stdout, as a kubectl wrapper script may.
+    """
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.processes = []
+        self.pid_files = []
+
+    def command_watch(self, resource, name=None, selector=None):
+        pid_file = str(self.tmp_path / ('watch-%d' % len(self.pid_files)))
+        process = subprocess.Popen(['sh', '-c',
+            'sleep 30 & echo $! > %s; echo pod/%s; wait' %
+            (pid_file, resource)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        self.processes.append(process)
+        self.pid_files.append(pid_file)
+        return process
+
+
+def gone(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split(') ')[1][0] == 'Z'
+    except OSError:
+        return True
+
+
+def test_convergence_wait_stops_watches_with_descendants(tmp_path):
+    kube = WatchKube(tmp_path)
+    waiter = convergence.ConvergenceWaiter(kube, min_interval=30,
+                                           max_interval=30)
+    for i in range(3):
+        started = len(kube.pid_files)
+
+        def check():
+            # Done once every watch of this wait has forked its grandchild
+            # and reported, each report wakes the wait.
+            files = kube.pid_files[started:]
+            return len(files) == 2 and all(
+                os.path.exists(f) and open(f).read().strip()
+                for f in files), None
+
+        start = time.monotonic()
+        assert waiter.wait(check, 60, watches=[('pod', None, None),
+                                               ('configmap', None, None)])
+        # Woken by a watch and stopped at once, not after the 30s poll.
+        assert time.monotonic() - start < 10
+    assert all(p.poll() is not None and p.stdout.closed
+               for p in kube.processes)
+    pids = [int(open(f).read()) for f in kube.pid_files]
+    deadline = time.monotonic() + 5
+    while not all(gone(pid) for pid in pids) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert all(gone(pid) for pid in pids)
+
+
+def test_convergence_wait_times_out(tmp_path):
+    waiter = convergence.ConvergenceWaiter(WatchKube(tmp_path),
+                                           min_interval=0.05)
+    assert not waiter.wait(lambda: (False, None), 0.2)
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_single_flight_shares_one_call():
+    flight = concurrency.SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return {'nodes': []}
+
+    threads = run_threads(8, lambda: results.append(flight.do('k', slow)))
+    assert wait_until(lambda: flight.in_flight() == 1 and calls)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 8 and all(r is results[0] for r in results)
+    assert flight.in_flight() == 0
+    # Nothing is kept once the call returned.
+    assert flight.do('k', lambda: 'again') == 'again'
+
+
+def test_single_flight_shares_the_exception():
+    flight = concurrency.SingleFlight()
+    release = threading.Event()
+    calls = []
+    errors = []
+
+    def failing():
+        calls.append(1)
+        release.wait(5)
+        raise transport.TransportError('down')
+
+    def caller():
+        try:
+            flight.do('k', failing)
+        except transport.TransportError as e:
+            errors.append(e)
+
+    threads = run_threads(5, caller)
+    assert wait_until(lambda: calls)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(errors) == 5 and all(e is errors[0] for e in errors)
+
+
+def test_coalesced_read_keeps_its_priority():
+    release = threading.Event()
+    calls = []
+
+    def df():
+        calls.append(1)
+        if len(calls) == 1:
+            # The audit read is slow, e.g. behind the rate limit.
+            release.wait(5)
+        return CEPH_DF
+
+    op = ceph.RookCephOperator('rook-ceph', transports=[StubTransport({
+        ('fsid',): {'fsid': 'x'}, ('df',): df})])
+
+    def audit():
+        with op.scheduler.priority(scheduler.Priority.audit):
+            op.execute_toolbox_cli(['df'])
+
+    threads = run_threads(1, audit)
+    assert wait_until(lambda: calls)
+    # The interactive read does not join the audit one.
+    assert op.execute_toolbox_cli(['df']) == CEPH_DF
+    assert len(calls) == 2
+    release.set()
+    threads[0].join()
+
+
+OSD_TREE = {'nodes': [
+    {'id': -1, 'name': 'storage-tier', 'type': 'root', 'type_id': 10,
+     'children': [-2]},
+    {'id': -2, 'name': 'controller-0', 'type': 'host', 'type_id': 1,
+     'children': [0]},
+    {'id': 0, 'name': 'osd.0', 'type': 'osd', 'type_id': 0,
+     'crush_weight': 0.0195, 'depth': 2, 'exists': 1, 'status': 'up',
+     'reweight': 1.0, 'primary_affinity': 1.0}], 'stray': []}
+
+
+def test_epoch_cache_keeps_records_not_dicts():
+    stub = StubTransport({('fsid',): {'fsid': 'x'},
+                          ('osd', 'stat'): {'epoch': 5},
+                          ('osd', 'tree'): lambda: copy.deepcopy(OSD_TREE)})
+    api = ceph_api.RookCephApi('rook-ceph', transports=[stub])
+    nodes = api.osd_tree_nodes()
+    assert [n.name for n in nodes] == ['storage-tier', 'controller-0', 'osd.0']
+    assert api.osd_tree_nodes() is nodes
+    assert stub.calls.count(('osd', 'tree')) == 1
+    cached = [entry[1] for entry in api.ceph_op.epoch_cache._entries.values()]
+    assert cached == [nodes]
+    assert not any(isinstance(item, dict) for item in nodes._items)
+
+
+def test_epoch_probes_expire_only_on_map_writes():
+    stub = StubTransport({('fsid',): {'fsid': 'x'},
+                          ('osd', 'stat'): {'epoch': 5},
+                          ('mon', 'stat'): {'epoch': 3},
+                          ('osd', 'tree'): OSD_TREE,
+                          ('mon', 'dump'): {'mons': []},
+                          ('tell', 'osd.0', 'perf', 'dump'): {},
+                          ('osd', 'pool', 'set', 'rbd', 'size', '2'): {}})
+    op = ceph.RookCephOperator('rook-ceph', transports=[stub])
+    op.epoch_cache.probe_ttl = 60
+    op.execute_toolbox_cli(['osd', 'tree'])
+    op.execute_toolbox_cli(['mon', 'dump'])
+    op.execute_toolbox_cli(['tell', 'osd.0', 'perf', 'dump'])
+    op.execute_toolbox_cli(['osd', 'tree'])
+    assert stub.calls.count(('osd', 'stat')) == 1
+    op.execute_toolbox_cli(['osd', 'pool', 'set', 'rbd', 'size', '2'])
+    op.execute_toolbox_cli(['osd', 'tree'])
+    op.execute_toolbox_cli(['mon', 'dump'])
+    assert stub.calls.count(('osd', 'stat')) == 2
+    assert stub.calls.count(('mon', 'stat')) == 1
+
+
+def blocked_scheduler(**kwargs):
+    # A scheduler whose only slot is held until the returned event is set.
+    sched = scheduler.CommandScheduler(max_concurrency=1, **kwargs)
+    release = threading.Event()
+    threads = run_threads(1, lambda: sched.run(
+        scheduler.Priority.interactive, release.wait, 5))
+    assert wait_until(lambda: sched.metrics()['interactive']['running'] == 1)
+    return sched, release, threads
+
+
+def test_scheduler_admits_by_priority():
+    sched, release, threads = blocked_scheduler(rate=0)
+    order = []
+    for priority in (scheduler.Priority.bulk, scheduler.Priority.audit,
+                     scheduler.Priority.interactive):
+        threads += run_threads(1, lambda p=priority: sched.run(
+            p, order.append, p))
+        assert wait_until(
+            lambda p=priority: sched.metrics()[p.name]['queued'] == 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert order == [scheduler.Priority.interactive, scheduler.Priority.audit,
+                     scheduler.Priority.bulk]
+
+
+def test_scheduler_liveness_has_a_reserved_slot():
+    sched, release, threads = blocked_scheduler(rate=0)
+    threads += run_threads(1, lambda: sched.run(
+        scheduler.Priority.audit, lambda: None))
+    assert wait_until(lambda: sched.metrics()['audit']['queued'] == 1)
+    assert sched.run(scheduler.Priority.liveness, lambda: 'up') == 'up'
+    assert sched.metrics()['audit']['queued'] == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+
+
+def test_scheduler_rate_limit():
+    sched = scheduler.CommandScheduler(rate=20, burst=1)
+    start = time.time()
+    for i in range(5):
+        sched.run(scheduler.Priority.interactive, lambda: None)
+    # The burst covers the first call, the other four wait for a token.
+    assert time.time() - start >= 0.15
+    start = time.time()
+    for i in range(5):
+        sched.run(scheduler.Priority.liveness, lambda: None)
+    assert time.time() - start < 0.1
+
+
+def test_scheduler_token_wait_holds_no_slot():
+    sched = scheduler.CommandScheduler(max_concurrency=1, rate=0)
+    slow = scheduler.TokenBucket(rate=2, burst=1)
+
+    def audit():
+        with sched.priority(scheduler.Priority.audit), sched.budget(slow):
+            for i in range(2):
+                sched.run(sched.current_priority(), lambda: None)
+
+    threads = run_threads(1, audit)
+    assert wait_until(lambda: sched.metrics()['audit'] == dict(
+        sched.metrics()['audit'], completed=1, queued=1, running=0))
+    start = time.time()
+    sched.run(scheduler.Priority.interactive, lambda: None)
+    assert time.time() - start < 0.25
+    threads[0].join()
+    assert sched.metrics()['audit']['completed'] == 2
+
+
+def test_scheduler_metrics():
+    sched, release, threads = blocked_scheduler(rate=0)
+    threads += run_threads(2, lambda: sched.run(
+        scheduler.Priority.bulk, lambda: None))
+    assert wait_until(lambda: sched.metrics()['bulk']['queued'] == 2)
+    metrics = sched.metrics()
+    assert metrics['interactive']['running'] == 1
+    assert metrics['bulk']['running'] == 0
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    metrics = sched.metrics()
+    assert metrics['interactive'] == dict(metrics['interactive'],
+                                          queued=0, running=0, completed=1)
+    assert metrics['bulk'] == dict(metrics['bulk'], queued=0, running=0,
+                                   completed=2)
+    assert metrics['bulk']['wait_max'] >= 0.1
+    assert 0 < metrics['bulk']['wait_avg'] <= metrics['bulk']['wait_max']
+    assert metrics['liveness']['completed'] == 0
+    assert metrics['liveness']['wait_avg'] == 0.0
+
+
+def test_tracing_spans_nest():
+    tracer = tracing.Tracer()
+    tracer.enable(slow_threshold=0)
+    with tracer.start_as_current_span('call', {'cli': 'osd tree'}):
+        with tracer.start_as_current_span('transport') as span:
+            assert tracer.current_span() is span
+            try:
+                with tracer.start_as_current_span('process'):
+                    raise transport.TransportError('down')
+            except transport.TransportError:
+                pass
+        with tracer.start_as_current_span('parse'):
+            pass
+    assert tracer.current_span() is tracing.NOOP_SPAN
+    [call] = tracer.slow_calls()
+    assert call['attributes'] == {'cli': 'osd tree'}
+    assert [c['name'] for c in call['children']] == ['transport', 'parse']
+    [process] = call['children'][0]['children']
+    assert process['status'] == tracing.STATUS_ERROR
+    assert process['events'][0]['type'] == 'TransportError'
+    assert call['children'][0]['status'] == tracing.STATUS_OK
+
+
+def test_tracing_slow_log_evicts_oldest():
+    tracer = tracing.Tracer()
+    tracer.enable(slow_threshold=0.05, slow_log_size=2)
+    for name in ('a', 'fast', 'b', 'c'):
+        with tracer.start_as_current_span(name):
+            if name != 'fast':
+                time.sleep(0.05)
+    assert [call['name'] for call in tracer.slow_calls()] == ['b', 'c']
+    assert 'c ' in tracer.format_slow_calls(clear=True)
+    assert tracer.slow_calls() == []
+
+
+def test_tracing_disabled_is_a_noop():
+    tracer = tracing.Tracer()
+    with tracer.start_as_current_span('call') as span:
+        assert span is tracing.NOOP_SPAN
+        assert tracer.current_span() is tracing.NOOP_SPAN
+        span.set_attribute('cli', 'osd tree')
+    assert tracer.slow_calls() == []
+    assert tracer._stack() == []
+
+    calls = []
+
+    class Api(object):
+        def status(self):
+            calls.append(tracing.current_span())
+            return 'ok'
+
+    tracing.instrument(Api)
+    tracing.disable()
+    assert Api().status() == 'ok'
+    assert calls == [tracing.NOOP_SPAN]
+
+
+def test_tracing_keeps_long_calls_out_of_the_slow_log():
+
+    class Api(object):
+        def status(self):
+            return 'ok'
+
+        def wait_for_health_ok(self):
+            for i in range(10):
+                self.status()
+
+        def collect(self):
+            for i in range(10):
+                self.status()
+
+    tracing.instrument(Api, long_running=('wait_for_health_ok',))
+    tracing.enable(slow_threshold=0, max_children=4)
+    try:
+        Api().wait_for_health_ok()
+        assert tracing.get_tracer().slow_calls() == []
+        Api().collect()
+        [call] = tracing.get_tracer().slow_calls(clear=True)
+    finally:
+        tracing.disable()
+    assert call['name'] == 'Api.collect'
+    assert len(call['children']) == 4
+    assert call['attributes'] == {'span.dropped_children': 6}
+
+
+CRUSH_BUCKET = {'id': -1, 'name': 'storage-tier', 'type_id': 10,
+                'type_name': 'root', 'weight': 2555, 'alg': 'straw2',
+                'hash': 'rjenkins1',
+                'items': [{'id': -2, 'weight': 1277, 'pos': 0},
+                          {'id': -3, 'weight': 1278, 'pos': 1}]}
+
+
+def test_records_round_trip():
+    bucket = ceph_model.CrushBucket.from_dict(CRUSH_BUCKET)
+    assert list(bucket.item_ids) == [-2, -3]
+    assert list(bucket.item_weights) == [1277, 1278]
+    assert bucket.to_dict() == CRUSH_BUCKET
+    assert ceph_model.CrushBucket.from_dict(bucket.to_dict()) == bucket
+    empty = ceph_model.CrushBucket.from_dict(dict(CRUSH_BUCKET, items=[]))
+    assert empty.to_dict()['items'] == [] and empty != bucket
+
+    host = OSD_TREE['nodes'][1]
+    node = ceph_model.OsdNode.from_dict(host)
+    assert node.id == -2 and list(node.children) == [0] and not node.is_osd
+    data = node.to_dict()
+    assert dict((k, data[k]) for k in host) == host
+    assert ceph_model.OsdNode.from_dict(data) == node
+    osd = ceph_model.OsdNode.from_dict(OSD_TREE['nodes'][2])
+    assert osd.is_osd and osd.status == 'up' and osd.crush_weight == 0.0195
+
+    pg = {'pgid': '1.0', 'state': 'active+undersized', 'up': [0, 1],
+          'acting': [0], 'up_primary': 0, 'acting_primary': 0}
+    stat = ceph_model.PgStat.from_dict(pg)
+    assert stat.to_dict() == pg
+    assert ceph_model.PgStat.from_dict(stat.to_dict()) == stat
+
+    pool = ceph_model.PoolStats.from_dict({'id': 1, 'name': 'kube-rbd',
+        'stats': {'bytes_used': 4096, 'max_avail': 100, 'objects': 2}})
+    assert pool.kb_used == 4 and pool.stored == 4096
+    assert ceph_model.PoolStats(**pool.to_dict()) == pool
+
+
+def test_record_list_converts_lazily():
+    raw = copy.deepcopy(OSD_TREE['nodes'])
+    nodes = ceph_model.RecordList(ceph_model.OsdNode, raw)
+    assert len(nodes) == 3
+    assert all(isinstance(item, dict) for item in nodes._items)
+    host = nodes[1]
+    assert isinstance(host, ceph_model.OsdNode) and nodes[1] is host
+    assert nodes[-2] is host
+    assert [type(item) for item in nodes._items] == \
+        [dict, ceph_model.OsdNode, dict]
+    assert [n.name for n in nodes[1:]] == ['controller-0', 'osd.0']
+    assert sorted(nodes.by_id()) == [-2, -1, 0]
+    assert not any(isinstance(item, dict) for item in nodes._items)
+    assert nodes.to_dicts()[2]['children'] == []
+    # The payload list itself is not modified.
+    assert raw == OSD_TREE['nodes']
+    assert len(ceph_model.RecordList(ceph_model.OsdNode, None)) == 0
+
+
+def df_node(id, name, type, children=(), kb=0):
+    return {'id': id, 'name': name, 'type': type, 'type_id': 0,
+            'children': list(children), 'kb': kb, 'kb_used': 0,
+            'kb_avail': kb, 'utilization': 0.0, 'pgs': 0}
+
+
+def test_get_tiers_size_from_osd_df_tree():
+    gib = 1024 ** 2
+    osd_df_tree = {'nodes': [
+        df_node(-1, 'storage-tier', 'root', [-3, -4], 9 * gib),
+        df_node(-3, 'group-0', 'chassis', [-5, -6], 5 * gib),
+        df_node(-5, 'controller-0', 'host', [0], 2 * gib),
+        df_node(0, 'osd.0', 'osd', kb=2 * gib),
+        df_node(-6, 'controller-1', 'host', [1], 3 * gib),
+        df_node(1, 'osd.1', 'osd', kb=3 * gib),
+        df_node(-4, 'group-1', 'chassis', [-7], 4 * gib),
+        df_node(-7, 'storage-0', 'host', [2], 4 * gib),
+        df_node(2, 'osd.2', 'osd', kb=4 * gib),
+        df_node(-2, 'ssd-tier', 'root', [-8], gib),
+        df_node(-8, 'group-2', 'chassis', [-9], gib),
+        df_node(-9, 'storage-1', 'host', [], gib)],
+        'stray': [], 'summary': {'total_kb': 10 * gib}}
+    stub = StubTransport({('fsid',): {'fsid': 'x'},
+                          ('osd', 'df', 'tree'): osd_df_tree})
+    api = ceph_api.RookCephApi('rook-ceph', transports=[stub])
+    # A tier holds one copy per chassis, the size of its smallest host.
+    assert api.get_tiers_size() == {'storage-tier': 6.0, 'ssd-tier': 1.0}
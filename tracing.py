@@ -0,0 +1,331 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Opt-in tracing of client calls.
+
+When enabled, every RookCephApi method opens a span, and the operator,
+transport, kubectl process and output parsing open nested spans under it
+with timings, exit codes and payload sizes. Root spans slower than the
+threshold are kept with their whole tree in a ring log that can be dumped
+on demand. Calls that are slow by design (waits, fan-outs) are traced but
+kept out of the ring log, and a span keeps at most max_children children so
+one call cannot fill it with a huge tree.
+
+The span API follows OpenTelemetry (start_as_current_span, set_attribute,
+set_status, record_exception) but does not need it. With
+use_opentelemetry=True and the opentelemetry package importable, every span
+is mirrored to an OpenTelemetry span as well. Disabled, a span costs one
+attribute check.
+"""
+
+import collections
+import functools
+import threading
+import time
+
+SLOW_THRESHOLD = 1.0
+SLOW_LOG_SIZE = 100
+MAX_CHILDREN = 50
+
+STATUS_UNSET = 'UNSET'
+STATUS_OK = 'OK'
+STATUS_ERROR = 'ERROR'
+
+
+def _otel_value(value):
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return str(value)
+
+
+class Span(object):
+
+    def __init__(self, name, parent=None, attributes=None, otel_span=None,
+                 slow_log=True):
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.dropped_children = 0
+        self.slow_log = slow_log
+        self.status = STATUS_UNSET
+        self.status_description = None
+        self.events = []
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self._otel = otel_span
+        if otel_span is not None and self.attributes:
+            for key, value in self.attributes.items():
+                otel_span.set_attribute(key, _otel_value(value))
+
+    def is_recording(self):
+        return self.duration is None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+        if self._otel is not None:
+            self._otel.set_attribute(key, _otel_value(value))
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_status(self, status, description=None):
+        self.status = status
+        self.status_description = description
+
+    def record_exception(self, exception):
+        self.events.append(dict(name='exception',
+            type=type(exception).__name__, message=str(exception)))
+        if self._otel is not None:
+            self._otel.record_exception(exception)
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+            if self.dropped_children:
+                self.set_attribute('span.dropped_children',
+                    self.dropped_children)
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    start_time=self.start_time,
+                    duration=self.duration,
+                    status=self.status,
+                    status_description=self.status_description,
+                    attributes=dict(self.attributes),
+                    events=list(self.events),
+                    children=[child.to_dict() for child in self.children])
+
+
+class _NoopSpan(object):
+
+    def is_recording(self):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def set_status(self, status, description=None):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _NoopContext(object):
+
+    def __enter__(self):
+        return NOOP_SPAN
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NOOP_CONTEXT = _NoopContext()
+
+
+class _SpanContext(object):
+
+    def __init__(self, tracer, name, attributes, slow_log=True):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.slow_log = slow_log
+        self.span = None
+        self._otel_context = None
+
+    def __enter__(self):
+        otel_span = None
+        if self.tracer.otel_tracer is not None:
+            self._otel_context = self.tracer.otel_tracer.start_as_current_span(
+                self.name)
+            otel_span = self._otel_context.__enter__()
+        stack = self.tracer._stack()
+        parent = stack[-1] if stack else None
+        self.span = Span(self.name, parent, self.attributes, otel_span,
+                         self.slow_log)
+        if parent is not None:
+            # Past the cap the span still runs and nests, it is only left out
+            # of its parent's tree.
+            if len(parent.children) < self.tracer.max_children:
+                parent.children.append(self.span)
+            else:
+                parent.dropped_children += 1
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        span = self.span
+        if exc_value is not None:
+            span.record_exception(exc_value)
+            span.set_status(STATUS_ERROR, str(exc_value))
+        elif span.status == STATUS_UNSET:
+            span.set_status(STATUS_OK)
+        span.end()
+        stack = self.tracer._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        if span.parent is None:
+            self.tracer._finish_root(span)
+        if self._otel_context is not None:
+            self._otel_context.__exit__(exc_type, exc_value, tb)
+        return False
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = SLOW_THRESHOLD
+        self.max_children = MAX_CHILDREN
+        self.otel_tracer = None
+        self._slow = collections.deque(maxlen=SLOW_LOG_SIZE)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, slow_threshold=SLOW_THRESHOLD, slow_log_size=SLOW_LOG_SIZE,
+               use_opentelemetry=False, max_children=MAX_CHILDREN):
+        self.slow_threshold = slow_threshold
+        self.max_children = max_children
+        with self._lock:
+            self._slow = collections.deque(self._slow, maxlen=slow_log_size)
+        self.otel_tracer = None
+        if use_opentelemetry:
+            try:
+                from opentelemetry import trace as otel_trace
+                self.otel_tracer = otel_trace.get_tracer('python-rookclient')
+            except ImportError:
+                print("opentelemetry is not installed, tracing locally.")
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.otel_tracer = None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start_as_current_span(self, name, attributes=None, slow_log=True):
+        if not self.enabled:
+            return NOOP_CONTEXT
+        return _SpanContext(self, name, attributes, slow_log)
+
+    def current_span(self):
+        if not self.enabled:
+            return NOOP_SPAN
+        stack = self._stack()
+        return stack[-1] if stack else NOOP_SPAN
+
+    def _finish_root(self, span):
+        if span.slow_log and span.duration >= self.slow_threshold:
+            with self._lock:
+                self._slow.append(span.to_dict())
+
+    def slow_calls(self, clear=False):
+        with self._lock:
+            calls = list(self._slow)
+            if clear:
+                self._slow.clear()
+        return calls
+
+    def format_slow_calls(self, clear=False):
+        lines = []
+
+        def add(span, depth):
+            attributes = ' '.join(
+                ('%s=%.6g' if isinstance(value, float) else '%s=%s') %
+                (key, value) for key, value in
+                sorted(span['attributes'].items()))
+            lines.append('%s%s %.3fs %s %s' % ('  ' * depth, span['name'],
+                span['duration'], span['status'], attributes))
+            for child in span['children']:
+                add(child, depth + 1)
+
+        for span in self.slow_calls(clear):
+            lines.append(time.strftime('%Y-%m-%d %H:%M:%S',
+                time.localtime(span['start_time'])))
+            add(span, 1)
+        return '\n'.join(lines)
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+def enable(slow_threshold=SLOW_THRESHOLD, slow_log_size=SLOW_LOG_SIZE,
+           use_opentelemetry=False, max_children=MAX_CHILDREN):
+    _tracer.enable(slow_threshold, slow_log_size, use_opentelemetry,
+                   max_children)
+
+
+def disable():
+    _tracer.disable()
+
+
+def span(name, attributes=None):
+    return _tracer.start_as_current_span(name, attributes)
+
+
+def current_span():
+    return _tracer.current_span()
+
+
+def traced(name, slow_log=True):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _tracer.enabled:
+                return func(*args, **kwargs)
+            with _tracer.start_as_current_span(name, slow_log=slow_log):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(cls, prefix=None, exclude=(), long_running=()):
+    """
+    Wrap every public method of cls, except those in exclude, in a span
+    named prefix.method. The calls of the methods in long_running are
+    traced but never kept in the slow call log.
+    """
+    prefix = prefix or cls.__name__
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith('_') or attr in exclude or not callable(value):
+            continue
+        setattr(cls, attr, traced('%s.%s' % (prefix, attr),
+            slow_log=attr not in long_running)(value))
+    return cls
@@ -0,0 +1,371 @@
+#   Copyright 2011 OpenStack Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Credit: python-rookclient
+#
+
+"""
+Transports that run a ceph CLI and return its decoded output.
+
+- RadosTransport: librados mon_command in process, when the rados and
+  ceph_argparse bindings are importable on the host.
+- LocalCliTransport: the ceph CLI on the host, when it and an admin keyring
+  are installed.
+- ToolboxTransport: kubectl exec into the rook-ceph-tools pod, always
+  available while the pod runs.
+
+TransportSelector probes the available transports, orders the working ones
+by latency and fails over to the next one when a transport breaks.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import yaml
+import kube_api as api
+import tracing as tracing
+
+CEPH_CONF = '/etc/ceph/ceph.conf'
+CEPH_KEYRING = '/etc/ceph/ceph.client.admin.keyring'
+
+# A transport marked down, or that failed the last probe, is tried again
+# after this many seconds.
+REPROBE_INTERVAL = 60
+
+PROBE_CLI = ['ceph', 'fsid', '--format', 'json-pretty']
+
+# stderr of the ceph CLI when it cannot reach or authenticate to the cluster,
+# as opposed to the command itself failing.
+CONNECT_ERRORS = ['error connecting to the cluster', 'RADOS timed out',
+                  'RADOS permission denied', 'monclient', 'auth:']
+
+
+class TransportError(api.ApiError):
+    """
+    The transport could not run the command at all; another transport may
+    succeed. Failures of the command itself are raised as api.ApiError.
+    """
+    pass
+
+
+class Transport(object):
+    name = None
+
+    def available(self):
+        return True
+
+    def supports(self, cli):
+        return True
+
+    def execute(self, cli, timeout=None):
+        raise NotImplementedError
+
+
+class ToolboxTransport(Transport):
+    name = 'toolbox'
+
+    def __init__(self, kube_op, pod_app, find_pod=None):
+        self.kube_op = kube_op
+        self.pod_app = pod_app
+        self.find_pod = find_pod
+
+    def execute(self, cli, timeout=None):
+        if self.find_pod is not None:
+            pod = self.find_pod()
+        else:
+            pod = self.kube_op.command_find_pod(self.pod_app)
+        if not pod:
+            raise TransportError("Error when get pod %s." % self.pod_app)
+        return self.kube_op.command_execute_cli(pod, " ".join(cli), timeout)
+
+
+class LocalCliTransport(Transport):
+    name = 'local'
+
+    def __init__(self, conf=CEPH_CONF, keyring=CEPH_KEYRING):
+        self.conf = conf
+        self.keyring = keyring
+
+    def available(self):
+        return (shutil.which('ceph') is not None and
+                os.path.exists(self.conf) and os.path.exists(self.keyring))
+
+    def supports(self, cli):
+        return cli[:1] == ['ceph']
+
+    def execute(self, cli, timeout=None):
+        command = cli[:1] + ['--conf', self.conf, '--keyring', self.keyring]
+        command += cli[1:]
+        with tracing.span('process', {'process.command_args': command}) \
+                as span:
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+            except OSError as e:
+                raise TransportError(str(e))
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise TransportError("Timeout when execute %s." %
+                    " ".join(cli))
+            span.set_attribute('process.exit_code', process.returncode)
+            span.set_attribute('process.stdout_bytes', len(stdout))
+
+            if process.returncode != 0:
+                message = stderr.decode(errors='replace')
+                if any(error in message for error in CONNECT_ERRORS):
+                    raise TransportError(stderr)
+                raise api.ApiError(stderr)
+        with tracing.span('parse', {'parse.bytes': len(stdout)}):
+            return yaml.safe_load(stdout)
+
+
+class RadosTransport(Transport):
+    name = 'rados'
+
+    def __init__(self, conf=CEPH_CONF, keyring=CEPH_KEYRING):
+        self.conf = conf
+        self.keyring = keyring
+        self._lock = threading.Lock()
+        self._cluster = None
+        self._sigdict = None
+
+    def available(self):
+        try:
+            import ceph_argparse
+            import rados
+        except ImportError:
+            return False
+        return os.path.exists(self.conf) and os.path.exists(self.keyring)
+
+    def supports(self, cli):
+        # 'tell' needs a daemon connection, leave it to the CLI transports.
+        return cli[:1] == ['ceph'] and cli[1:2] != ['tell']
+
+    def _connect(self, timeout):
+        import ceph_argparse
+        import rados
+
+        with self._lock:
+            if self._cluster is not None:
+                return self._cluster, self._sigdict
+            cluster = rados.Rados(conffile=self.conf,
+                conf=dict(keyring=self.keyring))
+            cluster.connect(timeout=timeout or 0)
+            ret, outbuf, outs = ceph_argparse.json_command(cluster,
+                prefix='get_command_descriptions', timeout=timeout or 0)
+            if ret != 0:
+                cluster.shutdown()
+                raise TransportError(outs)
+            self._sigdict = ceph_argparse.parse_json_funcsigs(
+                outbuf.decode('utf-8'), 'cli')
+            self._cluster = cluster
+            return self._cluster, self._sigdict
+
+    def _reset(self):
+        with self._lock:
+            if self._cluster is not None:
+                self._cluster.shutdown()
+            self._cluster = None
+            self._sigdict = None
+
+    def execute(self, cli, timeout=None):
+        import ceph_argparse
+        import rados
+
+        # Drop 'ceph' and the --format flag, the command is sent as json.
+        args = list(cli[1:])
+        if '--format' in args:
+            index = args.index('--format')
+            del args[index:index + 2]
+        try:
+            cluster, sigdict = self._connect(timeout)
+        except rados.Error as e:
+            self._reset()
+            raise TransportError(str(e))
+
+        command = ceph_argparse.validate_command(sigdict, args)
+        if not command:
+            raise api.ApiError("Invalid command: %s" % " ".join(args))
+        command['format'] = 'json'
+        with tracing.span('rados.mon_command',
+                          {'rados.prefix': command.get('prefix')}) as span:
+            try:
+                ret, outbuf, outs = cluster.mon_command(json.dumps(command),
+                    b'', timeout=timeout or 0)
+            except rados.Error as e:
+                self._reset()
+                raise TransportError(str(e))
+            span.set_attribute('rados.return_code', ret)
+            span.set_attribute('rados.output_bytes', len(outbuf))
+            if ret != 0:
+                raise api.ApiError(outs)
+        if not outbuf:
+            return None
+        with tracing.span('parse', {'parse.bytes': len(outbuf)}):
+            return json.loads(outbuf.decode('utf-8'))
+
+
+class TransportSelector(object):
+
+    def __init__(self, transports, reprobe_interval=REPROBE_INTERVAL):
+        self.transports = transports
+        self.reprobe_interval = reprobe_interval
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._ordered = None
+        self._latency = {}
+        self._down_until = {}
+        # Available transports that failed their probe, probed again in the
+        # background every reprobe_interval.
+        self._failed = set()
+        self._reprobe_at = 0
+        self._reprobing = False
+
+    def _probe_one(self, transport, timeout):
+        start = time.time()
+        transport.execute(PROBE_CLI, timeout)
+        return time.time() - start
+
+    def probe(self, timeout=10):
+        """
+        Time a small command on every available transport and order the
+        working ones from fastest to slowest.
+        """
+        latency = {}
+        failed = set()
+        for transport in self.transports:
+            try:
+                if not transport.available():
+                    continue
+                latency[transport.name] = self._probe_one(transport, timeout)
+            except Exception as e:
+                print("Transport %s is not usable: %s." % (transport.name, e))
+                failed.add(transport.name)
+
+        with self._lock:
+            self._latency = latency
+            self._failed = failed
+            self._reprobe_at = time.time() + self.reprobe_interval
+            self._down_until = {}
+            self._ordered = sorted(
+                [t for t in self.transports if t.name in latency],
+                key=lambda t: latency[t.name])
+        return dict(latency)
+
+    def _add(self, transport, latency):
+        with self._lock:
+            self._failed.discard(transport.name)
+            self._down_until.pop(transport.name, None)
+            self._latency[transport.name] = latency
+            if transport not in self._ordered:
+                self._ordered.append(transport)
+            self._ordered.sort(key=lambda t: self._latency[t.name])
+
+    def _reprobe_failed(self, timeout=10):
+        try:
+            for transport in self.transports:
+                if transport.name not in self._failed:
+                    continue
+                try:
+                    self._add(transport, self._probe_one(transport, timeout))
+                except Exception as e:
+                    print("Transport %s is still not usable: %s." %
+                        (transport.name, e))
+        finally:
+            with self._lock:
+                self._reprobe_at = time.time() + self.reprobe_interval
+                self._reprobing = False
+
+    def _maybe_reprobe(self):
+        # Transports that failed the probe are probed again off the request
+        # path; those that are not available on this host never are.
+        with self._lock:
+            if (self._reprobing or not self._failed or
+                    time.time() < self._reprobe_at):
+                return
+            self._reprobing = True
+        thread = threading.Thread(target=self._reprobe_failed,
+            name='rookclient-transport-reprobe')
+        thread.daemon = True
+        thread.start()
+
+    def current(self):
+        candidates = self._candidates()
+        return candidates[0].name if candidates else None
+
+    def _candidates(self):
+        with self._probe_lock:
+            if self._ordered is None:
+                self.probe()
+        self._maybe_reprobe()
+        now = time.time()
+        with self._lock:
+            candidates = [t for t in self._ordered
+                          if self._down_until.get(t.name, 0) <= now]
+            if not candidates:
+                # Everything failed recently, try them all again.
+                self._down_until = {}
+                candidates = list(self._ordered)
+        if not candidates:
+            # Nothing answered the probe, keep the ordering of the list.
+            candidates = [t for t in self.transports if t.available()]
+        return candidates
+
+    def execute(self, cli, timeout=None, only=None):
+        """
+        Run the cli on the fastest working transport, or on the transport
+        named `only` (e.g. commands that read or write files in the toolbox
+        pod). Fail over to the next transport on TransportError. When all
+        of them failed, the transports that failed their probe are tried
+        as a last resort.
+        """
+        if only:
+            candidates = [t for t in self.transports if t.name == only]
+        else:
+            candidates = [t for t in self._candidates() if t.supports(cli)]
+
+        error = TransportError("No transport for %s." % " ".join(cli))
+        tried = []
+        last_resort = False
+        while candidates:
+            transport = candidates.pop(0)
+            tried.append(transport)
+            try:
+                start = time.time()
+                with tracing.span('transport.%s' % transport.name):
+                    output = transport.execute(cli, timeout)
+                if last_resort:
+                    self._add(transport, time.time() - start)
+                return output
+            except TransportError as e:
+                print("Transport %s failed, fail over: %s." %
+                    (transport.name, e))
+                error = e
+                with self._lock:
+                    self._down_until[transport.name] = \
+                        time.time() + self.reprobe_interval
+            if not candidates and not only and not last_resort:
+                last_resort = True
+                with self._lock:
+                    failed = set(self._failed)
+                candidates = [t for t in self.transports
+                              if t.name in failed and t not in tried and
+                              t.supports(cli)]
+        raise error